@@ -0,0 +1,97 @@
+"""
+Compare the per-call overhead of modifiers compiled into a single pipeline, to
+the nested wrappers they replaced.  No database is needed:
+
+    python -m dictapi.bench_modifiers
+"""
+from dictapi.dictapi import HTTPMethod, LastModified, NoRead, NoWrite, OK
+from types import SimpleNamespace
+import timeit
+
+MODIFIERS = (
+        (NoRead, 'password_hash'),
+        (NoWrite, 'password_hash'),
+        (LastModified, 'last_modified'),
+        )
+CALLS = 100000
+
+
+class Connection(object):
+
+    def __init__(self):
+        self.rollbacks = 0
+
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+
+class Method(HTTPMethod):
+
+    def call(self, *a, **kw):
+        return (OK, {'id':1, 'name':'Jake', 'password_hash':'foo'})
+
+
+
+def nested(modifier):
+    """
+    A Modifier as a nested wrapper, as all modifiers used to be.
+    """
+    def wrapper(call, column_name, *a, **kw):
+        response = modifier.pre(column_name, kw)
+        if response:
+            return response
+        code, result = call(*a, **kw)
+        modifier.post(column_name, result)
+        return (code, result)
+    return wrapper
+
+
+def nested_modify(method, modifier, *a, **kw):
+    """
+    The previous HTTPMethod.modify, which rolled-back after every wrapper.
+    """
+    call = method.call
+    def wrapper(*fa, **fkw):
+        result = modifier(call, *a, *fa, **fkw, **kw)
+        method.db_conn.rollback()
+        return result
+    method.call = wrapper
+
+
+def new_method():
+    conn = Connection()
+    api = SimpleNamespace(routed=lambda: None, local=SimpleNamespace(),
+            dictdb=SimpleNamespace(conn=conn))
+    apitable = SimpleNamespace(api=api, table=SimpleNamespace(name='person'))
+    return Method(apitable), conn
+
+
+def bench(method, conn):
+    conn.rollbacks = 0
+    seconds = timeit.timeit(lambda: method.call(id=1, name='Jake'),
+            number=CALLS)
+    return (seconds / CALLS * 1e6, conn.rollbacks / CALLS)
+
+
+def main():
+    unmodified, conn = new_method()
+    print('unmodified: {:.2f}us per call, {:.0f} rollbacks'.format(
+        *bench(unmodified, conn)))
+
+    compiled, conn = new_method()
+    for modifier, column_name in MODIFIERS:
+        compiled.modify(modifier, column_name)
+    print('compiled:   {:.2f}us per call, {:.0f} rollbacks'.format(
+        *bench(compiled, conn)))
+
+    chained, conn = new_method()
+    for modifier, column_name in MODIFIERS:
+        nested_modify(chained, nested(modifier), column_name)
+    print('nested:     {:.2f}us per call, {:.0f} rollbacks'.format(
+        *bench(chained, conn)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+A cache of encoded responses, shared by every process on a host that maps the
+same file.  Place the file on a tmpfs (such as /dev/shm) so it is never written
+to disk:
+
+    >>> api.cache = SharedCache('/dev/shm/dictapi')
+
+The file is divided into a header, a generation counter for each table, and a
+fixed number of fixed-size slots.  An entry is placed in one of PROBES slots
+following the hash of its key, and is only valid while its table's generation
+is unchanged; a write to a table increments the generation, invalidating all
+of its entries in every process.
+
+Writers hold a lock on the file.  Readers do not lock, each slot has a
+sequence number which is odd while the slot is being written.  A read that
+overlaps a write is a miss.
+
+A SharedCache may be built before worker processes are forked, each worker
+opens the file again so that their locks exclude each other.
+"""
+from contextlib import contextmanager
+from hashlib import blake2b
+from zlib import crc32
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import weakref
+
+CACHE_SLOTS = 4096
+# Bytes per slot, including the slot's header
+CACHE_SLOT_SIZE = 4096
+# Tables are hashed into this many generation counters
+CACHE_GENERATIONS = 256
+# Number of slots an entry may be placed in
+PROBES = 4
+
+MAGIC = b'dictapi1'
+HEADER = struct.Struct('<8sIII')
+HEADER_SIZE = 64
+# A generation, or the sequence number of a slot
+COUNTER = struct.Struct('<Q')
+# seq, generation, digest of the key, length of the value
+SLOT = struct.Struct('<QQ16sI')
+SLOT_HEADER_SIZE = 40
+
+
+class SharedCache(object):
+
+    def __init__(self, path, slots=CACHE_SLOTS, slot_size=CACHE_SLOT_SIZE,
+            generations=CACHE_GENERATIONS):
+        if slot_size <= SLOT_HEADER_SIZE or slot_size % 8:
+            raise ValueError('Invalid slot size')
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.generations = generations
+        self.slots_offset = HEADER_SIZE + COUNTER.size * generations
+        self.size = self.slots_offset + slots * slot_size
+        # flock does not exclude threads sharing a file
+        self.lock = threading.Lock()
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        header = HEADER.pack(MAGIC, slots, slot_size, generations)
+        with self.locked():
+            if os.fstat(self.fd).st_size == 0:
+                os.ftruncate(self.fd, self.size)
+                os.pwrite(self.fd, header, 0)
+            matches = os.pread(self.fd, HEADER.size, 0) == header
+        if not matches:
+            os.close(self.fd)
+            raise ValueError('Cache file has a different layout')
+        self.mm = mmap.mmap(self.fd, self.size)
+
+        ref = weakref.ref(self)
+        os.register_at_fork(after_in_child=lambda: ref() and ref().reopen())
+
+
+    def reopen(self):
+        """
+        Open the file again in a forked process.  flock locks belong to the
+        open file, which a forked process shares with its parent.
+        """
+        if self.fd is None:
+            return
+        os.close(self.fd)
+        self.fd = os.open(self.path, os.O_RDWR)
+        # Another thread of the parent may have held the lock
+        self.lock = threading.Lock()
+
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+        self.fd = None
+
+
+    @contextmanager
+    def locked(self):
+        """
+        Exclude other threads, then other processes.
+        """
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+    def generation_offset(self, table_name):
+        index = crc32(table_name.encode()) % self.generations
+        return HEADER_SIZE + COUNTER.size * index
+
+
+    def generation(self, table_name):
+        """
+        Get a table's current generation.  Get this before reading the value
+        that will be put, so a write that happens in the meantime invalidates
+        it.
+        """
+        return COUNTER.unpack_from(self.mm,
+                self.generation_offset(table_name))[0]
+
+
+    def invalidate(self, table_name):
+        """
+        Invalidate every entry of a table, in every process.
+        """
+        offset = self.generation_offset(table_name)
+        with self.locked():
+            generation = COUNTER.unpack_from(self.mm, offset)[0]
+            COUNTER.pack_into(self.mm, offset, generation+1)
+
+
+    def offsets(self, digest):
+        first = int.from_bytes(digest[:8], 'little') % self.slots
+        for i in range(PROBES):
+            yield self.slots_offset + ((first+i) % self.slots) * self.slot_size
+
+
+    def get(self, table_name, key):
+        """
+        Get the value of a key, or None if it isn't cached or was invalidated.
+        """
+        digest = blake2b(key.encode(), digest_size=16).digest()
+        generation = self.generation(table_name)
+        mm = self.mm
+        for offset in self.offsets(digest):
+            seq, entry_generation, entry_digest, length = SLOT.unpack_from(mm,
+                    offset)
+            if seq % 2 or entry_digest != digest:
+                continue
+            if entry_generation != generation:
+                return None
+            start = offset + SLOT_HEADER_SIZE
+            # The length may be torn, never read past the slot
+            length = min(length, self.slot_size - SLOT_HEADER_SIZE)
+            value = mm[start:start+length]
+            if COUNTER.unpack_from(mm, offset)[0] != seq:
+                # Overwritten while reading
+                return None
+            return value
+        return None
+
+
+    def put(self, table_name, key, value, generation):
+        """
+        Store a value, if it was read during the generation provided and it
+        fits in a slot.  Returns True if it was stored.
+        """
+        if len(value) > self.slot_size - SLOT_HEADER_SIZE:
+            return False
+        digest = blake2b(key.encode(), digest_size=16).digest()
+        mm = self.mm
+        with self.locked():
+            if self.generation(table_name) != generation:
+                return False
+            # Replace this key, or an empty slot, or the first slot
+            choice = None
+            for offset in self.offsets(digest):
+                seq, _, entry_digest, _ = SLOT.unpack_from(mm, offset)
+                if entry_digest == digest:
+                    choice = offset
+                    break
+                if choice is None and seq == 0:
+                    choice = offset
+            if choice is None:
+                choice = next(self.offsets(digest))
+
+            seq = COUNTER.unpack_from(mm, choice)[0]
+            COUNTER.pack_into(mm, choice, seq+1)
+            SLOT.pack_into(mm, choice, seq+1, generation, digest, len(value))
+            start = choice + SLOT_HEADER_SIZE
+            mm[start:start+len(value)] = value
+            COUNTER.pack_into(mm, choice, seq+2)
+        return True
@@ -1,38 +1,343 @@
-from datetime import datetime, date
+from datetime import datetime, date, timezone
+from decimal import Decimal
 from dictapi.dictapi import APITable as OrigAPITable, API as OrigAPI
-from dictapi.dictapi import DATETIME_FORMAT, HTTP_METHODS
-from functools import wraps
+from dictapi.dictapi import DATETIME_FORMAT, HTTP_METHODS, OK, BAD_REQUEST
+from dictapi.dictapi import NOT_FOUND
+from dictapi.dictapi import error
+from functools import partial, wraps
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import cherrypy
 import json
+import select
+import socket
+import ssl
 import types
 
+try:
+    import msgpack
+except ImportError: # pragma: no cover
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError: # pragma: no cover
+    cbor2 = None
+
+EXPORT_CONTENT_TYPES = {
+        'ndjson':'application/x-ndjson',
+        'csv':'text/csv',
+        }
+
+
+def number(obj):
+    # Numeric values, such as sums, are integers when they can be
+    return int(obj) if obj == obj.to_integral_value() else float(obj)
+
 
 def json_serial(obj):
     if isinstance(obj, (datetime, date)):
         return obj.isoformat()
+    elif isinstance(obj, Decimal):
+        return number(obj)
+    raise TypeError("Type {} not serializable".format(type(obj))
+            ) # pragma: no cover
+
+
+def no_refs(entry):
+    """
+    Remove references from a dictorm.Dict, except those that were expanded,
+    see HTTPMethod.expand
+    """
+    refs = entry.table.refs
+    expanded = getattr(entry, 'expanded', ())
+    return {k:v for k, v in entry.items() if k not in refs or k in expanded}
+
+
+def msgpack_serial(obj, tz=timezone.utc):
+    # Timestamps are encoded natively, naive timestamps are in tz, see
+    # API.session_timezone
+    if isinstance(obj, datetime):
+        if not obj.tzinfo:
+            obj = obj.replace(tzinfo=tz)
+        return msgpack.Timestamp.from_datetime(obj)
+    elif isinstance(obj, date):
+        return obj.isoformat()
+    elif isinstance(obj, Decimal):
+        return number(obj)
     raise TypeError("Type {} not serializable".format(type(obj))
             ) # pragma: no cover
 
 
-def json_out(func):
+JSON = 'application/json'
+# Each encoder is passed the result and the timezone of naive timestamps
+ENCODERS = {
+        JSON:lambda i, tz: json.dumps(i, default=json_serial).encode(),
+        }
+DECODERS = {
+        JSON:json.loads,
+        }
+if msgpack:
+    ENCODERS['application/msgpack'] = lambda i, tz: msgpack.packb(i,
+            default=partial(msgpack_serial, tz=tz))
+    DECODERS['application/msgpack'] = lambda i: msgpack.unpackb(i,
+            timestamp=3)
+    ENCODERS['application/x-msgpack'] = ENCODERS['application/msgpack']
+    DECODERS['application/x-msgpack'] = DECODERS['application/msgpack']
+if cbor2:
+    ENCODERS['application/cbor'] = lambda i, tz: cbor2.dumps(i, timezone=tz)
+    DECODERS['application/cbor'] = cbor2.loads
+
+
+def negotiate():
+    """
+    Get the content type of the response from the Accept header of the
+    request, JSON is the default.
+    """
+    for element in cherrypy.request.headers.elements('Accept'):
+        if element.value in ENCODERS and element.qvalue > 0:
+            return element.value
+    return JSON
+
+
+def strip_refs(result):
+    # Remove references from any dictorm.Dict, even within lists
+    if 'no_refs' in dir(result):
+        return no_refs(result)
+    elif isinstance(result, (list, tuple)):
+        return [strip_refs(i) for i in result]
+    return result
+
+
+def encode(result, content_type=JSON, tz=timezone.utc):
+    # Output should at least contain an empty dict
+    return ENCODERS[content_type](strip_refs(result) or {}, tz)
+
+
+def encoded_out(func, api=None):
+    """
+    Encode the result of a call as requested by the Accept header.  Naive
+    timestamps are encoded in the session timezone of the API, if provided.
+    """
     @wraps(func)
     def wrapper(*a, **kw):
-        cherrypy.response.headers['Content-Type'] = 'application/json'
+        content_type = negotiate()
+        cherrypy.response.headers['Content-Type'] = content_type
+        cherrypy.response.headers['Vary'] = 'Accept'
         code, result = func(*a, **kw)
+        cherrypy.response.status = code
+        tz = api.session_timezone() if api else timezone.utc
+        return encode(result, content_type, tz)
+    return wrapper
 
-        # Remove references from any dictorm.Dict
-        if 'no_refs' in dir(result):
-            result = result.no_refs()
-        elif isinstance(result, list):
-            result = [i.no_refs() for i in result]
 
-        cherrypy.response.status = code
-        # Output should at least contain an empty dict
-        out = json.dumps(result or {}, default=json_serial).encode()
-        return out
+def decoded_in(func):
+    """
+    Pass the entry in a JSON, MessagePack or CBOR request body as keyword
+    arguments.  Form encoded bodies are already passed by CherryPy.
+    """
+    @wraps(func)
+    def wrapper(*a, **kw):
+        content_type = cherrypy.request.headers.get('Content-Type', '')
+        decoder = DECODERS.get(content_type.split(';')[0].strip())
+        if decoder:
+            body = cherrypy.request.body.read()
+            if body:
+                try:
+                    body = decoder(body)
+                except Exception:
+                    return (BAD_REQUEST, error('Invalid body'))
+                # MessagePack and CBOR keys may be bytes, integers...
+                if not isinstance(body, dict) or \
+                        not all(isinstance(i, str) for i in body):
+                    return (BAD_REQUEST, error('Invalid body'))
+                kw.update(body)
+        return func(*a, **kw)
     return wrapper
 
 
+def request_socket():
+    """
+    Get the socket of the current request, or None.  CherryPy doesn't expose
+    it; with cheroot the request's file is read from a buffered reader of a
+    socket.SocketIO, which keeps its socket in _sock.  Anything else, such as
+    another server or a TLS socket (which can't be peeked), is ignored.
+    """
+    reader = cherrypy.request.rfile
+    for name in ('rfile', 'raw', '_sock'):
+        reader = getattr(reader, name, None)
+    if isinstance(reader, socket.socket) and \
+            not isinstance(reader, ssl.SSLSocket):
+        return reader
+    return None
+
+
+def client_disconnected():
+    """
+    Get a function that checks if the client of the current request has
+    disconnected, or None if the client's socket can't be found.
+    """
+    sock = request_socket()
+    if sock is None:
+        return None
+
+    def disconnected():
+        try:
+            readable, _, _ = select.select([sock,], [], [], 0)
+            # A readable socket with nothing to read has been closed
+            return bool(readable) and not sock.recv(1, socket.MSG_PEEK)
+        except (OSError, ValueError):
+            return True
+    return disconnected
+
+
+def watched(api, func):
+    """
+    Cancel the queries of a call once the request has lasted longer than the
+    API's request_timeout, or its client has disconnected (if the API's
+    cancel_on_disconnect is set).
+    """
+    @wraps(func)
+    def wrapper(*a, **kw):
+        if not api.request_timeout and not api.cancel_on_disconnect:
+            return func(*a, **kw)
+        disconnected = None
+        if api.cancel_on_disconnect:
+            disconnected = client_disconnected()
+        with api.deadline(api.request_timeout, disconnected):
+            return func(*a, **kw)
+    return wrapper
+
+
+class Export:
+    """
+    Streams all entries of a table: /table/_export?format=csv&fields=id,name
+    """
+
+    exposed = True
+    _cp_config = {'response.stream':True}
+
+    def __init__(self, apitable):
+        self.apitable = apitable
+
+
+    def GET(self, **kw):
+        code, result = self.apitable.EXPORT(**kw)
+        cherrypy.response.status = code
+        if code != OK:
+            cherrypy.response.headers['Content-Type'] = JSON
+            return encode(result)
+        cherrypy.response.headers['Content-Type'] = \
+                EXPORT_CONTENT_TYPES[kw.get('format', 'ndjson')]
+        return result
+
+
+
+class Aggregate:
+    """
+    Computes aggregates of a table:
+    /table/_aggregate?aggregates=count,max:id&group_by=manager_id
+    """
+
+    exposed = True
+
+    def __init__(self, apitable):
+        self.apitable = apitable
+        self.GET = encoded_out(watched(apitable.api, apitable.AGGREGATE),
+                apitable.api)
+
+
+
+class Import:
+    """
+    Loads entries into a table from the request body, which is never read into
+    memory entirely: PUT /table/_import?format=csv
+    """
+
+    exposed = True
+    _cp_config = {'request.process_request_body':False}
+
+    def __init__(self, apitable):
+        self.apitable = apitable
+
+
+    def PUT(self, format='ndjson'):
+        table_name = self.apitable.table.name
+        def progress(imported, error_count):
+            cherrypy.log('Imported {} entries into {}, {} errors'.format(
+                imported, table_name, error_count))
+        import_ = watched(self.apitable.api, self.apitable.IMPORT)
+        return encoded_out(import_, self.apitable.api)(cherrypy.request.body,
+                format=format, progress=progress)
+
+
+
+class Batch:
+    """
+    Performs a list of operations in one request, see dictapi.API.batch:
+
+        POST /_batch?atomic=1
+        [{"method":"PUT", "table":"person", "body":{"name":"Jake"}}, ...]
+
+    Responds with the [code, result] of each operation.
+    """
+
+    exposed = True
+
+    def __init__(self, api):
+        self.api = api
+
+
+    def POST(self, atomic=False):
+        content_type = cherrypy.request.headers.get('Content-Type', JSON)
+        decoder = DECODERS.get(content_type.split(';')[0].strip(),
+                DECODERS[JSON])
+
+        def batch():
+            try:
+                operations = decoder(cherrypy.request.body.read())
+            except Exception:
+                return (BAD_REQUEST, error('Invalid body'))
+            if not isinstance(operations, list):
+                return (BAD_REQUEST, error('Invalid body'))
+            perform = watched(self.api, self.api.batch)
+            return (OK, perform(operations,
+                atomic=atomic not in (False, '', '0', 'false')))
+        return encoded_out(batch, self.api)()
+
+
+
+class SlowRequests:
+    """
+    Lists the most recent slow requests, see dictapi.API.trace:
+
+        GET /_slow?table=person&min_seconds=2
+
+    Their statements include the values they were executed with, so this is
+    only served if the API's serve_slow_requests is set.
+    """
+
+    exposed = True
+
+    def __init__(self, api):
+        self.api = api
+
+
+    def GET(self, table=None, min_seconds=0):
+        def slow_requests():
+            if not self.api.serve_slow_requests:
+                return (NOT_FOUND, error('Not found'))
+            try:
+                seconds = float(min_seconds)
+            except (TypeError, ValueError):
+                # Such as a repeated parameter
+                return (BAD_REQUEST, error('Invalid min_seconds'))
+            return (OK, [i for i in list(self.api.slow_requests)
+                if (not table or i['table'] == table) and
+                    i['seconds'] >= seconds])
+        return encoded_out(slow_requests, self.api)()
+
+
+
 class APITable:
 
     exposed = True
@@ -41,6 +346,9 @@ class APITable:
         self.api = api
         self.table = table
         self.apitable = OrigAPITable(api, table)
+        self._aggregate = Aggregate(self.apitable)
+        self._export = Export(self.apitable)
+        self._import = Import(self.apitable)
 
         for method_name in HTTP_METHODS:
             if method_name not in dir(self.apitable):
@@ -50,7 +358,9 @@ class APITable:
                 # Don't overwrite existing methods of THIS APITable, (see GET)
                 continue
             original_method = getattr(self.apitable, method_name)
-            setattr(self, method_name, json_out(original_method))
+            setattr(self, method_name,
+                    encoded_out(decoded_in(watched(api, original_method)),
+                        api))
 
 
     def _options(self):
@@ -60,16 +370,58 @@ class APITable:
     def GET(self, *a, **kw):
         """
         If Range is passed in the HTTP headers, use GET_RANGE, otherwise use GET
+
+        The response is encoded as requested by the Accept header, identical
+        concurrent GETs share a single encoded response; each waits only until
+        its own request is cancelled, see dictapi.SingleFlight.  If the API
+        has a cache, entries got by their primary key from the primary are
+        cached.
         """
         ranges = cherrypy.request.headers.get('Range', None)
         a = list(a)
         if ranges:
-            get = getattr(self.apitable, 'GET_RANGE')
+            method_name = 'GET_RANGE'
             a.insert(0, ranges)
         else:
-            get = getattr(self.apitable, 'GET')
-        result = json_out(get)(*a, **kw)
-        return result
+            method_name = 'GET'
+        get = getattr(self.apitable, method_name)
+
+        content_type = negotiate()
+        cherrypy.response.headers['Content-Type'] = content_type
+        cherrypy.response.headers['Vary'] = 'Accept'
+
+        cache = self.api.cache
+        # Only entries gotten by their primary keys, a reference or substratum
+        # contains entries of other tables
+        cacheable = cache is not None and method_name == 'GET' and \
+                len(a) == len(self.table.pks) and not kw
+        if cacheable:
+            cache_key = '{} {} {}'.format(content_type, self.table.name,
+                    json.dumps(a))
+            out = cache.get(self.table.name, cache_key)
+            if out is not None:
+                cherrypy.response.status = OK
+                return out
+            generation = cache.generation(self.table.name)
+
+        def encoded_get(*a, **kw):
+            code, result = get(*a, **kw)
+            # A replica may not have replayed the write that invalidated the
+            # cache, what it read is not cached
+            replicated = getattr(self.api.local, 'replica', None) is not None
+            return (code, encode(result, content_type,
+                self.api.session_timezone()), replicated)
+
+        single_flight = self.api.single_flight
+        key = single_flight.key(self.table.name, content_type+' '+method_name,
+                a, kw)
+        def coalesced(*a, **kw):
+            return single_flight.do(key, encoded_get, *a, **kw)
+        code, out, replicated = watched(self.api, coalesced)(*a, **kw)
+        if cacheable and code == OK and not replicated:
+            cache.put(self.table.name, cache_key, out, generation)
+        cherrypy.response.status = code
+        return out
 
 
     def OPTIONS(self):
@@ -82,12 +434,72 @@ class APITable:
 
 class API(OrigAPI):
 
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        # Seconds a request's queries may run before they are cancelled
+        self.request_timeout = None
+        # Cancel a request's queries if its client disconnects
+        self.cancel_on_disconnect = False
+        # A SharedCache of GET responses, see dictapi.cache
+        self.cache = None
+        self._batch = Batch(self)
+        # Serve the recent slow requests at /_slow, including the values of
+        # their statements
+        self.serve_slow_requests = False
+        self._slow = SlowRequests(self)
+
+
     @classmethod
     def table_factory(cls): return APITable
 
 
+    def session_timezone(self):
+        """
+        Get the TimeZone of the primary's session.  Naive timestamps (of
+        TIMESTAMP columns) are encoded in it, just as PostgreSQL converts the
+        aware timestamps of a request body to it; so a GET then PUT of an
+        entry never shifts its timestamps.  A zone Python doesn't know is
+        assumed to be UTC.
+        """
+        name = self.db_conn.info.parameter_status('TimeZone')
+        try:
+            return ZoneInfo(name)
+        except (TypeError, ValueError, ZoneInfoNotFoundError):
+            return timezone.utc
+
+
+    def written(self, table_name):
+        super().written(table_name)
+        if self.cache is not None:
+            self.cache.invalidate(table_name)
+
+
+    def refresh_tables(self, schema_conn=None):
+        """
+        Refresh the tables, then mount any new tables in the application this
+        API is mounted in.
+        """
+        changed = super().refresh_tables(schema_conn)
+        for table_name in changed:
+            if self.cache is not None:
+                self.cache.invalidate(table_name)
+        if changed:
+            config = self.generate_config()
+            for app in cherrypy.tree.apps.values():
+                if app.root is self:
+                    app.merge(config)
+        return changed
+
+
     def generate_config(self):
-        config = {}
+        config = {
+                '/_batch':{
+                    'request.dispatch':cherrypy.dispatch.MethodDispatcher()
+                    },
+                '/_slow':{
+                    'request.dispatch':cherrypy.dispatch.MethodDispatcher()
+                    },
+                }
         for table_name in self.dictdb:
             config['/'+str(table_name)] = {
                     'request.dispatch':cherrypy.dispatch.MethodDispatcher()
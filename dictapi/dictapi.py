@@ -1,16 +1,110 @@
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from dictorm import DictDB
-from functools import wraps
+from functools import partial, wraps
+from logging.handlers import RotatingFileHandler
+from psycopg2 import sql
+from psycopg2.extras import DictCursor
+import collections
+import csv
+import io
+import json
+import logging
 import psycopg2
+import queue
+import random
+import select
+import threading
+import time
+import weakref
 
 __all__ = ['COLLECTION_SIZE', 'API', 'APITable',
         'NoWrite',
-        'NoRead'
+        'NoRead',
         'LastModified',
+        'Modifier',
+        'SingleFlight',
+        'Replica',
         ]
 
 COLLECTION_SIZE = 20
+# Seconds the estimated width of a table's entries is reused
+ENTRY_WIDTH_INTERVAL = 300
+# Estimated bytes of each JSON encoded entry, from the statistics gathered by
+# ANALYZE.  Each column is also given the bytes of its name, quotes and
+# separators.
+ENTRY_WIDTH_QUERY = '''SELECT sum(avg_width + length(attname) + 6)
+    FROM pg_stats WHERE schemaname = 'public' AND tablename = %s'''
 DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+# Seconds a replica may lag behind the primary, and seconds after a write to a
+# table during which reads of that table are sent to the primary
+MAX_STALENESS = 1.0
+# Seconds the measured lag of a replica is reused
+REPLICA_CHECK_INTERVAL = 1.0
+# A replica that has replayed everything it received isn't lagging, no matter
+# how long ago the primary was last written to
+REPLICA_LAG_QUERY = '''SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'''
+# COPY options for each export format.  NDJSON is copied as CSV with quote and
+# delimiter characters that can't appear in JSON, so each row is copied as is.
+EXPORT_FORMATS = {
+        'ndjson':"FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02'",
+        'csv':'FORMAT csv, HEADER',
+        }
+# Chunks of an export that may be buffered before COPY waits for them to be
+# read
+EXPORT_BUFFER_SIZE = 16
+# Functions an aggregate may use
+AGGREGATE_FUNCTIONS = ('avg', 'count', 'max', 'min', 'sum')
+# Results of aggregates kept by each table, see APITable.aggregate_ttl
+AGGREGATE_RESULTS_KEPT = 1000
+IMPORT_FORMATS = ('ndjson', 'csv')
+# Entries copied, and commited, at once by an import
+IMPORT_BATCH_SIZE = 1000
+# Errors reported by an import before the rest are only counted
+IMPORT_MAX_ERRORS = 100
+# Methods that may be performed by a batch
+BATCH_METHODS = ('DELETE', 'GET', 'GET_RANGE', 'HEAD', 'PUT')
+# Seconds between each check of a deadline, see API.deadline
+DEADLINE_POLL_INTERVAL = 0.1
+# A checksum of the columns of each table, a changed checksum means the table
+# must be refreshed.  The tables are those DictDB loads.
+SCHEMA_CHECKSUM_QUERY = '''SELECT table_name, md5(string_agg(column_name || ' '
+        || udt_name || ' ' || is_nullable, ',' ORDER BY ordinal_position))
+    FROM information_schema.columns
+    WHERE table_schema = 'public'
+    GROUP BY table_name'''
+# Seconds between each comparison of the schema checksums, see
+# API.watch_schema
+SCHEMA_POLL_INTERVAL = 10
+SCHEMA_CHANNEL = 'dictapi_schema'
+# Slow requests kept by an API, see API.slow_request_threshold
+SLOW_REQUESTS_KEPT = 100
+# Size of each slow request log file, and number of files kept, see
+# API.log_slow_requests
+SLOW_LOG_BYTES = 10 * 1024 * 1024
+SLOW_LOG_BACKUPS = 5
+EXPLAIN = 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) '
+# Slow requests waiting to be explained, any more are logged without their
+# plans
+EXPLAIN_QUEUE_SIZE = 10
+# Seconds each explained statement may run, see API.explain_timeout
+EXPLAIN_TIMEOUT = 10
+# Install this (as a superuser) to notify API.watch_schema of any schema change
+SCHEMA_EVENT_TRIGGER = '''
+CREATE OR REPLACE FUNCTION dictapi_schema_notify() RETURNS event_trigger AS $$
+BEGIN
+    PERFORM pg_notify('dictapi_schema', tg_tag);
+END
+$$ LANGUAGE plpgsql;
+DROP EVENT TRIGGER IF EXISTS dictapi_schema;
+CREATE EVENT TRIGGER dictapi_schema ON ddl_command_end
+    EXECUTE PROCEDURE dictapi_schema_notify();
+'''
+
+
+SLOW_LOG = logging.getLogger('dictapi.slow')
 
 
 def error(msg):
@@ -20,6 +114,17 @@ OK = 200
 CREATED = 201
 BAD_REQUEST = 400
 NOT_FOUND = 404
+SERVICE_UNAVAILABLE = 503
+GATEWAY_TIMEOUT = 504
+
+
+def cancelled(exception):
+    """
+    Get the error response of a cancelled query.
+    """
+    if 'statement timeout' in str(exception.diag.message_primary):
+        return (GATEWAY_TIMEOUT, error('Query timed out'))
+    return (SERVICE_UNAVAILABLE, error('Query cancelled'))
 
 HTTP_METHODS = (
         'CONNECT',
@@ -33,52 +138,368 @@ HTTP_METHODS = (
         'TRACE',
         )
 
-def NoRead(call, column_name, *a, **kw):
-    code, result = call(*a, **kw)
-    # Remove the column without reporting it
-    result.pop(column_name, None)
-    return (code, result)
+class Modifier(object):
+    """
+    Modifies the calls of an HTTPMethod, see HTTPMethod.modify.  Before a call
+    is made, pre is passed the keyword arguments of the call which it may
+    change, or it may return an error response to stop the call.  After the
+    call is made, post is passed its result which it may change.
+    """
+
+    @staticmethod
+    def pre(column_name, kw):
+        pass
+
+
+    @staticmethod
+    def post(column_name, result):
+        pass
+
+
+
+class NoRead(Modifier):
+
+    @staticmethod
+    def post(column_name, result):
+        # Remove the column without reporting it
+        for entry in result if isinstance(result, list) else [result,]:
+            if isinstance(entry, dict):
+                entry.pop(column_name, None)
+
+
+
+class NoWrite(Modifier):
+
+    @staticmethod
+    def pre(column_name, kw):
+        if column_name in kw:
+            return (BAD_REQUEST,
+                    error('Cannot write to {}'.format(column_name)))
+
+
+
+class LastModified(Modifier):
+
+    @staticmethod
+    def pre(column_name, kw):
+        # PostgreSQL converts this to its session's TimeZone
+        kw[column_name] = datetime.now(timezone.utc)
+
+
+class Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+        # The leader's call was cancelled, its result is not shared
+        self.cancelled = False
+
+
+
+class SingleFlight(object):
+    """
+    Coalesce identical concurrent calls.  The first caller of a key executes
+    the call, any caller of the same key that arrives before it has finished
+    will wait for, and share, its result.
+
+    Every table has a generation which is part of each key.  A write to a table
+    increments its generation, so a read started after the write will never
+    share the result of a read started before it.
+
+    Shared results must not be mutable, the CherryPy API coalesces its GETs
+    once they are encoded.  A dictorm Dict is never shared, its callers may
+    update and flush it.
+
+    watch gets the Watch of the calling thread, if any, see API.deadline.  A
+    caller stops waiting once its own watch is cancelled, and makes the call
+    itself (which responds that it was cancelled).  The result of a leader
+    whose watch was cancelled is not shared, its callers make the call again.
+    """
+
+    def __init__(self, watch=None):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.generations = {}
+        self.watch = watch or (lambda: None)
+
+
+    def key(self, table_name, method_name, a, kw):
+        """
+        Build the key of a call, returns None if the call cannot be coalesced.
+        """
+        key = (table_name, self.generations.get(table_name, 0), method_name,
+                tuple(a), tuple(sorted(kw.items())))
+        try:
+            hash(key)
+        except TypeError:
+            # Unhashable arguments (such as a list of values)
+            return None
+        return key
 
 
-def NoWrite(call, column_name, *a, **kw):
-    if column_name in kw:
-        return (BAD_REQUEST,
-                error('Cannot write to {}'.format(column_name)))
-    # Column Name not passed, execute the call
-    return call(*a, **kw)
+    def do(self, key, call, *a, **kw):
+        if key is None:
+            return call(*a, **kw)
 
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+
+        watch = self.watch()
+        if not leader:
+            # Another caller is already executing this call, share its result
+            while not flight.done.wait(DEADLINE_POLL_INTERVAL):
+                if watch and watch.cancelled:
+                    return call(*a, **kw)
+            if flight.cancelled:
+                return self.do(key, call, *a, **kw)
+            if flight.exception:
+                raise flight.exception
+            return flight.result
+
+        try:
+            flight.result = call(*a, **kw)
+        except Exception as e:
+            flight.exception = e
+            raise
+        finally:
+            flight.cancelled = bool(watch and watch.cancelled)
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+
+    def invalidate(self, table_name):
+        with self.lock:
+            self.generations[table_name] = \
+                    self.generations.get(table_name, 0) + 1
+
+
+
+class CopyPipe(object):
+    """
+    A file-like object that COPY writes to in one thread, while the chunks
+    written are read in another thread.  Only EXPORT_BUFFER_SIZE chunks are
+    kept in memory.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(EXPORT_BUFFER_SIZE)
+        self.closed = False
+        self.exception = None
+
+
+    def write(self, chunk):
+        while True:
+            if self.closed:
+                # Nothing is reading, stop the COPY
+                raise IOError('Copy pipe is closed')
+            try:
+                self.queue.put(chunk, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+
+    def finish(self):
+        try:
+            self.write(None)
+        except IOError:
+            pass
+
+
+
+def copy_out(db_conn, query):
+    """
+    Execute a COPY ... TO STDOUT query in a separate thread, yield each chunk
+    that it outputs.  The COPY is stopped when this generator is closed, and
+    the connection, which must not be used by anything else, is closed.
+    """
+    pipe = CopyPipe()
+
+    def copy():
+        try:
+            db_conn.cursor().copy_expert(query, pipe)
+        except Exception as e:
+            pipe.exception = e
+        finally:
+            db_conn.close()
+            pipe.finish()
+
+    thread = threading.Thread(target=copy, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = pipe.queue.get()
+            if chunk is None:
+                break
+            yield chunk
+        if pipe.exception:
+            raise pipe.exception
+    finally:
+        pipe.closed = True
+        thread.join()
 
-def LastModified(call, column_name, *a, **kw):
-    kw[column_name] = datetime.now()
-    return call(*a, **kw)
 
 
 class HTTPMethod:
 
+    # Read only methods may be routed to a replica
+    read_only = False
+    # Slow calls of traced methods are logged, see API.slow_request_threshold
+    traced = False
+
     def __init__(self, apitable):
         self.api = apitable.api
         self.apitable = apitable
-        self.table = apitable.table
+        self.table_name = apitable.table.name
+        self.modifiers = []
+        self.unmodified = self.call
+        # Seconds a query of this method may run, overrides the table's
+        self.statement_timeout = None
+
+
+    @property
+    def dictdb(self):
+        """
+        The DictDB this call has been routed to, see API.route
+        """
+        return self.api.routed() or self.api.dictdb
+
+
+    @property
+    def table(self):
+        return self.dictdb[self.table_name]
+
+
+    @property
+    def db_conn(self):
+        """
+        The connection this call has been routed to, see RoutedConnection
+        """
+        return getattr(self.api.local, 'conn', None) or self.dictdb.conn
+
+
+    def get_statement_timeout(self):
+        """
+        Get the statement timeout of this method, if not set the timeout of its
+        table is used, then the timeout of the API.
+        """
+        for timeout in (self.statement_timeout,
+                self.apitable.statement_timeout, self.api.statement_timeout):
+            if timeout is not None:
+                return timeout
 
 
     def modify(self, modifier, *a, **kw):
-        call = self.call
-        @wraps(self.call)
-        def wrapper(*fa, **fkw):
-            result = modifier(call, *a, *fa, **fkw, **kw)
-            self.api.db_conn.rollback()
+        """
+        Apply a Modifier to this method, such as NoRead for a column:
+
+        >>> apitable.GET.modify(NoRead, 'password_hash')
+
+        The pre and post of every Modifier are compiled into a single pipeline
+        around the call, and the transaction is ended once after it.  Any
+        other callable is called as a wrapper around that pipeline:
+        modifier(call, *a, *call_args, **call_kwargs, **kw)
+        """
+        self.modifiers.append((modifier, a, kw))
+        pipeline = self.wrap(self.unmodified)
+
+        @wraps(self.unmodified)
+        def call(*a, **kw):
+            result = pipeline(*a, **kw)
+            self.db_conn.rollback()
             return result
-        self.call = wrapper
+        self.call = call
+
+
+    def expand(self, entries, expand):
+        """
+        Embed the references named in expand (comma separated) into each of the
+        entries.  Each referenced table is queried once for all entries, and
+        the modifiers of its GET are applied to each referenced entry.
+
+        Returns an error response if a reference can't be expanded.
+        """
+        for name in expand.split(','):
+            ref = self.table.refs.get(name)
+            if ref is None or ref._substratum:
+                return (BAD_REQUEST, error('Cannot expand {}'.format(name)))
+            table = self.dictdb[ref.column2.table.name]
+            fk, column = ref.column1.column, ref.column2.column
+
+            referenced = {}
+            keys = list({i[fk] for i in entries if i[fk] is not None})
+            if keys:
+                for entry in table.get_where(table[column].Any(keys)):
+                    referenced.setdefault(entry[column], []).append(entry)
+
+            get = self.api.apitables[table.name].GET.wrap(
+                    lambda entry, *a, **kw: (OK, entry))
+            for entry in entries:
+                found = [get(i.no_refs())[1] for i in
+                        referenced.get(entry[fk], [])]
+                if not ref.many:
+                    found = found[0] if found else None
+                dict.__setitem__(entry, name, found)
+                # Expanded references are kept by cpapi.no_refs
+                entry.expanded = getattr(entry, 'expanded', frozenset()) | \
+                        {name}
+
+
+    def wrap(self, call):
+        """
+        Wrap any call with the modifiers of this method.  Unlike the modified
+        call of this method, the transaction is not rolled-back.
+        """
+        pres, posts, wrappers = [], [], []
+        for modifier, a, kw in self.modifiers:
+            if isinstance(modifier, type) and issubclass(modifier, Modifier):
+                # The last modifier applied is the first to see the arguments
+                # and the last to see the result
+                pres.insert(0, partial(modifier.pre, *a, **kw))
+                posts.append(partial(modifier.post, *a, **kw))
+            else:
+                wrappers.append((modifier, a, kw))
+
+        def pipeline(*a, **kw):
+            for pre in pres:
+                response = pre(kw)
+                if response:
+                    return response
+            code, result = call(*a, **kw)
+            for post in posts:
+                post(result)
+            return (code, result)
+
+        for modifier, a, kw in wrappers:
+            pipeline = partial(modifier, pipeline, *a, **kw)
+        return pipeline
 
 
     def __call__(self, *a, **kw):
-        return self.call(*a, **kw)
+        watch = getattr(self.api.local, 'watch', None)
+        if watch and watch.cancelled:
+            return (SERVICE_UNAVAILABLE, error('Query cancelled'))
+        with self.api.route(self), self.api.trace(self, a, kw):
+            try:
+                return self.call(*a, **kw)
+            except psycopg2.extensions.QueryCanceledError as e:
+                self.db_conn.rollback()
+                return cancelled(e)
 
 
 
 class GET(HTTPMethod):
 
-    def call(self, *a, **kw):
+    read_only = True
+    traced = True
+
+    def call(self, *a, expand=None, **kw):
         entry = None
         if not kw and len(a) == len(self.table.pks):
             # Convert positional arguments to keyword arguments if there are the
@@ -93,44 +514,92 @@ class GET(HTTPMethod):
             # The object that contains references
             referenced = self.table.get_one(**wheres)
             if not referenced:
-                self.api.db_conn.rollback()
+                self.db_conn.rollback()
                 return (NOT_FOUND,
                         error('No entry matching: {}'.format(str(wheres))))
             # Keep moving down the object until the last reference is gotten
             while a:
                 current = a.pop(0)
                 if current not in referenced:
-                    self.api.db_conn.rollback()
+                    self.db_conn.rollback()
                     return (BAD_REQUEST, error('No reference exists'))
                 referenced = referenced[current]
-            self.api.db_conn.rollback()
+            self.db_conn.rollback()
             return (OK, referenced)
         if kw:
             try:
                 entry = self.table.get_one(**kw)
             except psycopg2.DataError:
-                self.api.db_conn.rollback()
+                self.db_conn.rollback()
                 return (BAD_REQUEST, error('Invalid primary key(s)'))
             except psycopg2.ProgrammingError:
-                self.api.db_conn.rollback()
+                self.db_conn.rollback()
                 return (BAD_REQUEST, error('Invalid name(s)'))
         if not entry:
-            self.api.db_conn.rollback()
+            self.db_conn.rollback()
             return (NOT_FOUND, error('No entry matching: {}'.format(str(kw))))
-        self.api.db_conn.rollback()
+        if expand:
+            expand_error = self.expand([entry,], expand)
+            if expand_error:
+                self.db_conn.rollback()
+                return expand_error
+        self.db_conn.rollback()
         return (OK, entry)
 
 
 
 class GET_RANGE(HTTPMethod):
 
+    read_only = True
+    traced = True
+
     def __init__(self, *a, **kw):
         super().__init__(*a, **kw)
-        self.maximum_range = COLLECTION_SIZE
+        self.entry_width, self.width_checked = None, None
+
+
+    @property
+    def maximum_range(self):
+        """
+        The most entries that will be returned at once.  This is the
+        collection_size of the table, unless its collection_bytes is set; then
+        it is as many entries as are estimated to fit in collection_bytes.
+        """
+        maximum_range = self.apitable.collection_size
+        collection_bytes = self.apitable.collection_bytes
+        if collection_bytes:
+            width = self.get_entry_width()
+            if width:
+                maximum_range = max(1, min(maximum_range,
+                    collection_bytes // width))
+        return maximum_range
+
+
+    @maximum_range.setter
+    def maximum_range(self, value):
+        self.apitable.collection_size = value
 
 
-    def call(self, ranges, *a, **kw):
-        offset, end = 0, COLLECTION_SIZE
+    def get_entry_width(self):
+        """
+        Get the estimated bytes of an entry, or None if the table has not been
+        analyzed.
+        """
+        now = time.monotonic()
+        if self.width_checked and \
+                now - self.width_checked < ENTRY_WIDTH_INTERVAL:
+            return self.entry_width
+        curs = self.db_conn.cursor()
+        curs.execute(ENTRY_WIDTH_QUERY, [self.table_name,])
+        width = curs.fetchone()[0]
+        self.entry_width = int(width) if width else None
+        self.width_checked = now
+        return self.entry_width
+
+
+    def call(self, ranges, *a, expand=None, **kw):
+        maximum_range = self.maximum_range
+        offset, end = 0, maximum_range
         if ranges:
             try:
                 if '-' not in ranges or ranges.count('-') != 1:
@@ -141,10 +610,12 @@ class GET_RANGE(HTTPMethod):
                 elif ranges.endswith('-'):
                     # Only offset is specified
                     offset = int(ranges.rstrip('-'))
+                    end = max(offset, 1) + maximum_range - 1
                 else:
                     offset, end = ranges.split('-')
                     offset, end = int(offset), int(end)
-            except ValueError:
+            except (TypeError, ValueError):
+                # Such as a range that isn't a string, from a batch
                 return (BAD_REQUEST, error('Invalid range value'))
 
         # Range is inclusive
@@ -152,20 +623,28 @@ class GET_RANGE(HTTPMethod):
 
         if offset >= end:
             return (BAD_REQUEST, error('Invalid range value'))
-        if end - offset > self.maximum_range:
-            offset = (end - self.maximum_range) - 1
+        if end - offset > maximum_range:
+            offset = end - maximum_range
 
         limit = end - offset
         entries = list(self.table.get_where().offset(offset).limit(limit))
-        self.api.db_conn.rollback()
         if not entries:
+            self.db_conn.rollback()
             return (NOT_FOUND, error('No entries found in range'))
+        if expand:
+            expand_error = self.expand(entries, expand)
+            if expand_error:
+                self.db_conn.rollback()
+                return expand_error
+        self.db_conn.rollback()
         return (OK, entries)
 
 
 
 class HEAD(HTTPMethod):
 
+    read_only = True
+
     def call(self, *a, **kw):
         return (self.apitable.GET(*a, **kw)[0], None)
 
@@ -188,12 +667,14 @@ class PUT(HTTPMethod):
             # Entry already exists, update it
             entry.update(kw)
             entry.flush()
-            self.api.db_conn.commit()
+            self.db_conn.commit()
+            self.api.written(self.table_name)
             return (OK, entry)
         elif get_code == 404:
             # No entry found, create it
             entry = self.table(**kw).flush()
-            self.api.db_conn.commit()
+            self.db_conn.commit()
+            self.api.written(self.table_name)
             return (CREATED, entry)
         else:
             # Error occured
@@ -214,9 +695,10 @@ class DELETE(HTTPMethod):
                 result = entry.delete()
             except psycopg2.IntegrityError:
                 # Can't delete the entry
-                self.api.db_conn.rollback()
+                self.db_conn.rollback()
                 return (BAD_REQUEST, error('Cannot delete referenced entry'))
-            self.api.db_conn.commit()
+            self.db_conn.commit()
+            self.api.written(self.table_name)
             return (OK, result)
         else:
             # Error occured
@@ -224,35 +706,1089 @@ class DELETE(HTTPMethod):
 
 
 
+def where(kw):
+    """
+    A WHERE clause matching each column of kw to its value, the values are
+    passed as list(kw.values()).
+    """
+    if not kw:
+        return sql.SQL('')
+    wheres = [sql.SQL('{} = %s').format(sql.Identifier(i)) for i in kw]
+    return sql.SQL(' WHERE ') + sql.SQL(' AND ').join(wheres)
+
+
+
+class EXPORT(HTTPMethod):
+    """
+    Stream the entries of a table using COPY.  The entries may be projected
+    using a comma separated list of fields, and filtered by any column.
+    Columns hidden from GET by NoRead are never exported.
+
+    Each COPY runs on a new connection, made by the API's export_connect,
+    which is closed once the COPY is done.
+    """
+
+    read_only = True
+
+    def call(self, format='ndjson', fields=None, **kw):
+        # A repeated query parameter is a list
+        if not isinstance(format, str) or \
+                not isinstance(fields, (str, type(None))):
+            return (BAD_REQUEST, error('Invalid argument(s)'))
+        if format not in EXPORT_FORMATS:
+            return (BAD_REQUEST, error('Invalid format'))
+        if not self.api.export_connect:
+            return (SERVICE_UNAVAILABLE, error('Exports are not enabled'))
+        fields = fields.split(',') if fields else []
+        hidden = self.apitable.hidden_columns()
+        names = set(fields).union(kw)
+        if names.difference(self.table.column_names) or names & hidden:
+            self.db_conn.rollback()
+            return (BAD_REQUEST, error('Invalid name(s)'))
+
+        if not fields and hidden:
+            fields = [i['column_name'] for i in sorted(self.table.columns_info,
+                key=lambda i: i['ordinal_position'])
+                if i['column_name'] not in hidden]
+        if fields:
+            columns = sql.SQL(', ').join(map(sql.Identifier, fields))
+        else:
+            columns = sql.SQL('*')
+        query = sql.SQL('SELECT {} FROM {}{}').format(columns,
+                sql.Identifier(self.table_name), where(kw))
+        # The values are checked before responding, the COPY only fails once
+        # the response has started
+        try:
+            self.db_conn.cursor().execute(query + sql.SQL(' LIMIT 0'),
+                    list(kw.values()) or None)
+        except (psycopg2.DataError, psycopg2.ProgrammingError):
+            # Such as a list of values compared to a column
+            self.db_conn.rollback()
+            return (BAD_REQUEST, error('Invalid value(s)'))
+        if format == 'ndjson':
+            query = sql.SQL('SELECT row_to_json(r) FROM ({}) r').format(query)
+        query = sql.SQL('COPY ({}) TO STDOUT WITH ({})').format(query,
+                sql.SQL(EXPORT_FORMATS[format]))
+
+        # The COPY runs after this call, the connections of this call may be
+        # used by other calls by then
+        self.db_conn.rollback()
+        db_conn = self.api.export_connect()
+        query = db_conn.cursor().mogrify(query, list(kw.values()) or None)
+        return (OK, copy_out(db_conn, query))
+
+
+
+class AGGREGATE(HTTPMethod):
+    """
+    Compute aggregates of a table in a single query:
+
+    >>> apitable.AGGREGATE('count,max:id', group_by='manager_id')
+
+    Each aggregate is one of AGGREGATE_FUNCTIONS and a column, the column may
+    be omitted for count.  The entries may be grouped by a comma separated list
+    of columns, and filtered by any column.  Columns hidden from GET by NoRead
+    can't be used.
+
+    If the APITable has an aggregate_ttl, results are reused for that many
+    seconds, or until the table is written to.
+    """
+
+    read_only = True
+
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        # (expiry, result) by the arguments of the call
+        self.results = {}
+
+
+    def call(self, aggregates='count', group_by=None, **kw):
+        # A repeated query parameter is a list
+        if not isinstance(aggregates, str) or \
+                not isinstance(group_by, (str, type(None))):
+            return (BAD_REQUEST, error('Invalid argument(s)'))
+        ttl = self.apitable.aggregate_ttl
+        try:
+            key = (aggregates, group_by, frozenset(kw.items()))
+            hash(key)
+        except TypeError:
+            ttl = None
+        if ttl:
+            expiry, result = self.results.get(key, (0, None))
+            if expiry > time.monotonic():
+                return (OK, result)
+
+        group_by = group_by.split(',') if group_by else []
+        columns = [sql.Identifier(i) for i in group_by]
+        names = set(group_by).union(kw)
+        for aggregate in aggregates.split(','):
+            function, _, column = aggregate.partition(':')
+            if function not in AGGREGATE_FUNCTIONS or \
+                    not (column or function == 'count'):
+                self.db_conn.rollback()
+                return (BAD_REQUEST, error('Invalid aggregate'))
+            names.add(column or None)
+            columns.append(sql.SQL('{}({}) AS {}').format(sql.SQL(function),
+                sql.Identifier(column) if column else sql.SQL('*'),
+                sql.Identifier(function+'_'+column if column else function)))
+        names.discard(None)
+        hidden = self.apitable.hidden_columns()
+        if names.difference(self.table.column_names) or names & hidden:
+            self.db_conn.rollback()
+            return (BAD_REQUEST, error('Invalid name(s)'))
+
+        query = sql.SQL('SELECT {} FROM {}{}').format(
+                sql.SQL(', ').join(columns), sql.Identifier(self.table_name),
+                where(kw))
+        if group_by:
+            group_by = sql.SQL(', ').join(map(sql.Identifier, group_by))
+            query += sql.SQL(' GROUP BY {0} ORDER BY {0}').format(group_by)
+
+        curs = self.db_conn.cursor()
+        try:
+            curs.execute(query, list(kw.values()) or None)
+        except psycopg2.DataError:
+            self.db_conn.rollback()
+            return (BAD_REQUEST, error('Invalid value(s)'))
+        except psycopg2.ProgrammingError:
+            # Such as the sum of a text column
+            self.db_conn.rollback()
+            return (BAD_REQUEST, error('Invalid aggregate'))
+        names = [i[0] for i in curs.description]
+        result = [dict(zip(names, i)) for i in curs.fetchall()]
+        self.db_conn.rollback()
+        if ttl:
+            self.keep(key, result, ttl)
+        return (OK, result)
+
+
+    def keep(self, key, result, ttl):
+        """
+        Keep a result for ttl seconds.  Expired results are dropped, and the
+        oldest results once AGGREGATE_RESULTS_KEPT are kept.
+        """
+        now = time.monotonic()
+        for old_key, (expiry, _) in list(self.results.items()):
+            if expiry <= now:
+                self.results.pop(old_key, None)
+        while len(self.results) >= AGGREGATE_RESULTS_KEPT:
+            self.results.pop(next(iter(self.results)), None)
+        self.results[key] = (now + ttl, result)
+
+
+
+def copy_value(value):
+    """
+    Format a value for COPY's text format.
+    """
+    if value is None:
+        return '\\N'
+    elif isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t'
+            ).replace('\n', '\\n').replace('\r', '\\r')
+
+
+
+class IMPORT(HTTPMethod):
+    """
+    Load entries into a table from an iterable of NDJSON or CSV lines, such as
+    a request body.  Entries are read in batches of IMPORT_BATCH_SIZE, the
+    modifiers of PUT are applied to each entry, then each batch is copied into
+    a temporary table and merged into this table.  Entries whose primary keys
+    already exist are updated.
+
+    Each batch is commited; progress (if provided) is called after each batch
+    with the count of entries imported and the errors so far.  A cancelled
+    import stops at the batch it was cancelled in.
+    """
+
+    def call(self, body, format='ndjson', progress=None):
+        if format not in IMPORT_FORMATS:
+            return (BAD_REQUEST, error('Invalid format'))
+
+        imported, errors, error_count = 0, [], 0
+        def report(lines, message):
+            nonlocal error_count
+            error_count += 1
+            if len(errors) < IMPORT_MAX_ERRORS:
+                errors.append({'lines':lines, 'message':str(message)})
+
+        # The modifiers of PUT are applied, but the entry is accepted instead of
+        # PUT
+        accepted = []
+        def accept(*a, **kw):
+            accepted.append(kw)
+            return (OK, {})
+        put = self.apitable.PUT.wrap(accept)
+
+        batch = []
+        entries = self.entries(body, format)
+        while True:
+            line, entry = next(entries, (None, None))
+            if line is not None:
+                if isinstance(entry, Exception):
+                    report([line, line], entry)
+                    continue
+                # The modifiers of PUT may change the entry, or reject it
+                code, result = put(**entry)
+                if code != OK:
+                    report([line, line], result['message'])
+                    continue
+                batch.append((line, accepted.pop()))
+                if len(batch) < IMPORT_BATCH_SIZE:
+                    continue
+            if batch:
+                lines = [batch[0][0], batch[-1][0]]
+                try:
+                    imported += self.merge([i for _, i in batch])
+                    self.db_conn.commit()
+                    self.api.written(self.table_name)
+                except psycopg2.extensions.QueryCanceledError:
+                    # The import stops, see HTTPMethod.__call__
+                    raise
+                except psycopg2.Error as e:
+                    self.db_conn.rollback()
+                    report(lines, e.diag.message_primary or e)
+                batch = []
+                if progress:
+                    progress(imported, error_count)
+            if line is None:
+                break
+
+        return (OK, {'imported':imported, 'errors':errors,
+            'error_count':error_count})
+
+
+    def entries(self, body, format):
+        """
+        Yield the line number and entry of each line of the body.  If the line
+        isn't a valid entry, the entry is an exception instead.
+        """
+        # Invalid UTF-8 is kept as surrogates, which check rejects
+        lines = (i.decode(errors='surrogateescape') if isinstance(i, bytes)
+                else i for i in body)
+        if format == 'csv':
+            # The line a CSV error is in, the reader's line_num isn't updated
+            read = 0
+            def counted():
+                nonlocal read
+                for read, line in enumerate(lines, 1):
+                    yield line
+
+            reader = csv.DictReader(counted())
+            while True:
+                try:
+                    row = next(reader)
+                except StopIteration:
+                    break
+                except csv.Error as e:
+                    yield (read, e)
+                    continue
+                # Empty CSV values are omitted, like a missing JSON key
+                entry = {k:v for k, v in row.items() if v != ''}
+                yield (reader.line_num, self.check(entry))
+        else:
+            for number, line in enumerate(lines, 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    yield (number, ValueError('Invalid JSON'))
+                    continue
+                yield (number, self.check(entry))
+
+
+    def check(self, entry):
+        if not isinstance(entry, dict) or not entry:
+            return ValueError('Invalid entry')
+        try:
+            json.dumps(entry, ensure_ascii=False).encode()
+        except UnicodeEncodeError:
+            return ValueError('Invalid UTF-8')
+        if any('\x00' in i for i in list(entry) + list(entry.values())
+                if isinstance(i, str)):
+            return ValueError('Invalid NUL character')
+        if set(entry).difference(self.table.column_names):
+            return ValueError('Invalid name(s)')
+        return entry
+
+
+    def merge(self, batch):
+        """
+        Copy a batch of entries into a temporary table, then insert (or
+        update) them into this table.  Entries are grouped by the columns they
+        contain.
+        """
+        groups = {}
+        for entry in batch:
+            groups.setdefault(tuple(sorted(entry)), []).append(entry)
+
+        curs = self.db_conn.cursor()
+        table = sql.Identifier(self.table_name)
+        merged = 0
+        for number, (names, entries) in enumerate(groups.items()):
+            staging = sql.Identifier('dictapi_import_{}'.format(number))
+            columns = sql.SQL(', ').join(map(sql.Identifier, names))
+            curs.execute(sql.SQL('CREATE TEMPORARY TABLE {} ON COMMIT DROP AS'
+                ' SELECT {} FROM {} WITH NO DATA').format(staging, columns,
+                    table))
+            data = io.StringIO(''.join(
+                '\t'.join(copy_value(entry[i]) for i in names) + '\n'
+                for entry in entries))
+            curs.copy_expert(sql.SQL('COPY {} ({}) FROM STDIN').format(
+                staging, columns), data)
+
+            query = sql.SQL('INSERT INTO {} ({}) SELECT {} FROM {}').format(
+                    table, columns, columns, staging)
+            pks = self.table.pks
+            if pks and set(pks).issubset(names):
+                updates = [sql.SQL('{0} = EXCLUDED.{0}').format(
+                    sql.Identifier(i)) for i in names if i not in pks]
+                conflict = sql.SQL(', ').join(map(sql.Identifier, pks))
+                if updates:
+                    query += sql.SQL(' ON CONFLICT ({}) DO UPDATE SET {}'
+                            ).format(conflict, sql.SQL(', ').join(updates))
+                else:
+                    query += sql.SQL(' ON CONFLICT ({}) DO NOTHING').format(
+                            conflict)
+            curs.execute(query)
+            merged += curs.rowcount
+        return merged
+
+
+
+# The statements executed by the call being traced in this thread, see
+# API.trace
+tracing = threading.local()
+# The RoutedConnection of the call being made in this thread, see API.route
+routing = threading.local()
+
+
+class Execution(object):
+    """
+    The thread executing a statement on a connection, so that a Watch only
+    cancels the statement of its own thread.  Statements of a TracedCursor are
+    executed one at a time on each connection, the thread is only cleared
+    before the next statement may start.
+    """
+
+    def __init__(self):
+        self.turn = threading.Lock()
+        self.lock = threading.Lock()
+        self.thread = None
+
+
+# The Execution of each connection
+executions = weakref.WeakKeyDictionary()
+executions_lock = threading.Lock()
+
+
+def execution(db_conn):
+    with executions_lock:
+        return executions.setdefault(db_conn, Execution())
+
+
+
+class TracedCursor(DictCursor):
+    """
+    Records the statements it executes, and their durations, while a call is
+    being traced in its thread.  Each statement is recorded as the statement
+    of its thread on the connection, see Execution, and is preceded by the
+    statement timeout of its call if it is the first of a transaction.
+    """
+
+    @contextmanager
+    def executing(self):
+        state = execution(self.connection)
+        with state.turn:
+            with state.lock:
+                state.thread = threading.get_ident()
+            try:
+                routed = getattr(routing, 'conn', None)
+                if routed is not None and routed.db_conn is self.connection:
+                    routed.begin(self)
+                yield
+            finally:
+                with state.lock:
+                    state.thread = None
+
+
+    def execute(self, query, vars=None):
+        with self.executing():
+            statements = getattr(tracing, 'statements', None)
+            if statements is None:
+                return super().execute(query, vars)
+            start = time.perf_counter()
+            try:
+                return super().execute(query, vars)
+            finally:
+                statements.append({
+                    'sql':self.query.decode() if self.query else str(query),
+                    'seconds':time.perf_counter() - start,
+                    })
+
+
+    def copy_expert(self, *a, **kw):
+        with self.executing():
+            return super().copy_expert(*a, **kw)
+
+
+
+class TracedDictDB(DictDB):
+    """
+    A DictDB whose queries are recorded while a call is being traced.
+    """
+
+    def get_cursor(self):
+        return self.conn.cursor(cursor_factory=TracedCursor)
+
+
+
+def share_references(dictdb, primary):
+    """
+    References are defined on the tables of the primary DictDB, share them
+    with the tables of another DictDB of the same database (or a copy of it).
+    """
+    for table_name, table in dictdb.items():
+        if table_name in primary:
+            table.refs = primary[table_name].refs
+            table.fks = primary[table_name].fks
+
+
+
+class RoutedConnection(object):
+    """
+    Wraps the connection a call has been routed to.  If the call has a
+    statement timeout, it is set by the first statement of each transaction,
+    see TracedCursor.  The calls of an atomic batch can't commit or rollback
+    its transaction, see API.batch
+    """
+
+    def __init__(self, db_conn, statement_timeout=None, atomic=False):
+        self.db_conn = db_conn
+        self.statement_timeout = statement_timeout
+        self.atomic = atomic
+        # The statement timeout was set in the current transaction
+        self.timeout_set = False
+
+
+    def begin(self, curs):
+        if self.statement_timeout and not self.timeout_set:
+            self.timeout_set = True
+            DictCursor.execute(curs, 'SET LOCAL statement_timeout = %s',
+                    [int(self.statement_timeout * 1000),])
+
+
+    def cursor(self, *a, **kw):
+        kw.setdefault('cursor_factory', TracedCursor)
+        return self.db_conn.cursor(*a, **kw)
+
+
+    def commit(self):
+        if not self.atomic:
+            self.db_conn.commit()
+            self.timeout_set = False
+
+
+    def rollback(self):
+        if not self.atomic:
+            self.db_conn.rollback()
+            self.timeout_set = False
+
+
+    def __getattr__(self, name):
+        return getattr(self.db_conn, name)
+
+
+
+class Watch(object):
+    """
+    The connection used by the calls within a deadline, see API.deadline
+    """
+
+    def __init__(self):
+        self.db_conn = None
+        self.cancelled = False
+        self.done = threading.Event()
+        self.thread = threading.get_ident()
+
+
+    def cancel(self):
+        """
+        Cancel the statement being executed, only if it is executed by the
+        thread of this watch; other threads may share its connection.
+        """
+        self.cancelled = True
+        db_conn = self.db_conn
+        if db_conn:
+            state = execution(db_conn)
+            with state.lock:
+                if state.thread == self.thread:
+                    db_conn.cancel()
+
+
+
+class Replica(object):
+    """
+    A read-only copy of the primary database that GET, GET_RANGE and HEAD may
+    be routed to.
+    """
+
+    def __init__(self, db_conn, primary):
+        self.db_conn = db_conn
+        self.dictdb = TracedDictDB(db_conn)
+        self.lock = threading.Lock()
+        # Calls currently routed to this replica
+        self.busy = 0
+        self.lag, self.checked = None, None
+        self.share_references(primary)
+
+
+    def share_references(self, primary):
+        """
+        References are defined on the tables of the primary, share them with
+        the tables of this replica.  Referenced entries are still gotten from
+        the primary.
+        """
+        share_references(self.dictdb, primary)
+
+
+    def get_lag(self):
+        """
+        Get the seconds this replica lags behind the primary, or None if it
+        has not replayed anything (or can't be reached).
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.checked and now - self.checked < REPLICA_CHECK_INTERVAL:
+                return self.lag
+            try:
+                curs = self.db_conn.cursor()
+                curs.execute(REPLICA_LAG_QUERY)
+                lag = curs.fetchone()[0]
+                self.db_conn.rollback()
+            except psycopg2.Error:
+                lag = None
+            self.lag = None if lag is None else float(lag)
+            self.checked = now
+            return self.lag
+
+
+
 class APITable(object):
 
     def __init__(self, api, table):
         self.api = api
         self.table = table
+        # The most entries GET_RANGE will return at once
+        self.collection_size = COLLECTION_SIZE
+        # Optionally, the most bytes GET_RANGE should return at once
+        self.collection_bytes = None
+        # Seconds a query may run, unless set by the method
+        self.statement_timeout = None
+        # Optionally, seconds the result of an aggregate is reused
+        self.aggregate_ttl = None
+        api.register(self)
 
+        self.AGGREGATE = AGGREGATE(self)
         self.DELETE = DELETE(self)
+        self.EXPORT = EXPORT(self)
         self.GET = GET(self)
         self.GET_RANGE = GET_RANGE(self)
         self.HEAD = HEAD(self)
+        self.IMPORT = IMPORT(self)
         self.PUT = PUT(self)
 
 
+    def hidden_columns(self):
+        """
+        The columns GET hides with NoRead, no other method may reveal them.
+        """
+        return {a[0] for modifier, a, _ in self.GET.modifiers
+                if modifier is NoRead}
+
+
+    def adopt(self, old):
+        """
+        Keep the settings and modifiers of the APITable this one replaces.
+        """
+        self.collection_size = old.collection_size
+        self.collection_bytes = old.collection_bytes
+        self.statement_timeout = old.statement_timeout
+        self.aggregate_ttl = old.aggregate_ttl
+        self.table.refs, self.table.fks = old.table.refs, old.table.fks
+        for name, old_method in vars(old).items():
+            method = getattr(self, name, None)
+            if not isinstance(old_method, HTTPMethod) or \
+                    not isinstance(method, HTTPMethod):
+                continue
+            method.statement_timeout = old_method.statement_timeout
+            for modifier, a, kw in old_method.modifiers:
+                method.modify(modifier, *a, **kw)
+
+
 
 class API(object):
 
-    def __init__(self, db_conn):
+    def __init__(self, db_conn, replicas=(), max_staleness=MAX_STALENESS,
+            replica_selection='round-robin'):
+        """
+        Reads are routed to the replicas, which are psycopg2 connections to
+        read-only copies of db_conn.  The replica is selected either
+        'round-robin' or 'least-busy', but only replicas lagging at most
+        max_staleness seconds behind db_conn will be used.
+        """
+        if replica_selection not in ('round-robin', 'least-busy'):
+            raise ValueError('Invalid replica selection')
         self.db_conn = db_conn
-        self.dictdb = DictDB(db_conn)
+        self.dictdb = TracedDictDB(db_conn)
+        # Seconds a query may run, unless set by the table or method
+        self.statement_timeout = None
+        # Makes a new connection for each export, such as
+        # partial(psycopg2.connect, dsn), exports are disabled without it
+        self.export_connect = None
+        # Makes a new connection for each atomic batch, atomic batches are
+        # disabled without it
+        self.batch_connect = None
+        # Seconds a GET or GET_RANGE may take before it is logged as slow
+        self.slow_request_threshold = None
+        # The most recent slow requests
+        self.slow_requests = collections.deque(maxlen=SLOW_REQUESTS_KEPT)
+        # The fraction of slow requests whose queries are explained, using a
+        # separate connection, and the seconds each explained query may run
+        self.explain_sample_rate = 0
+        self.explain_conn = None
+        self.explain_timeout = EXPLAIN_TIMEOUT
+        self.explain_queue = queue.Queue(EXPLAIN_QUEUE_SIZE)
+        self.explain_thread = None
+        self.explain_lock = threading.Lock()
+        self.replicas = [Replica(i, self.dictdb) for i in replicas]
+        self.max_staleness = max_staleness
+        self.replica_selection = replica_selection
+        self.next_replica = 0
+        self.last_writes = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.single_flight = SingleFlight(
+                partial(getattr, self.local, 'watch', None))
+        # The APITable of each table, by table name
+        self.apitables = {}
+        # The APITables built by refresh_tables, which are registered once they
+        # are complete
+        self.built = None
+        self.refresh_lock = threading.Lock()
         self.init_tables()
 
 
     def init_tables(self):
+        self.checksums = self.schema_checksums(self.db_conn)
         for table_name in self.dictdb:
             table = self.dictdb[table_name]
             apitable = self.table_factory()
             setattr(self, table_name, apitable(self, table))
 
 
+    def register(self, apitable):
+        """
+        Called by each new APITable (never the wrapper a table_factory may
+        return).
+        """
+        if self.built is not None:
+            self.built[apitable.table.name] = apitable
+        else:
+            self.apitables[apitable.table.name] = apitable
+
+
+    def schema_checksums(self, db_conn):
+        curs = db_conn.cursor()
+        curs.execute(SCHEMA_CHECKSUM_QUERY)
+        checksums = dict(curs.fetchall())
+        db_conn.rollback()
+        return checksums
+
+
+    def refresh_tables(self, schema_conn=None):
+        """
+        Rebuild the APITable of every table that was added or whose columns
+        have changed, and remove the APITable of every table that was dropped.
+        A rebuilt APITable keeps the settings and modifiers of the one it
+        replaces, and only replaces it once it has them.  Calls already using
+        the replaced APITable are unaffected.
+
+        The schema is compared using schema_conn, which is rolled-back.  It
+        defaults to the API's connection, which is only safe while no other
+        thread is using it; see watch_schema.
+
+        Returns the names of the tables that were changed.
+        """
+        with self.refresh_lock:
+            checksums = self.schema_checksums(schema_conn or self.db_conn)
+            changed = {k for k, v in checksums.items()
+                    if self.checksums.get(k) != v}
+            dropped = set(self.checksums).difference(checksums)
+            table_cls = self.dictdb.table_factory()
+
+            for table_name in changed:
+                old = self.apitables.get(table_name)
+                table = table_cls(table_name, self.dictdb)
+                self.built = {}
+                try:
+                    apitable = self.table_factory()(self, table)
+                    # The core APITable, even when the table_factory wraps it
+                    core = self.built[table_name]
+                finally:
+                    self.built = None
+                if old:
+                    core.adopt(old)
+                self.apitables[table_name] = core
+                self.dictdb[table_name] = table
+                for replica in self.replicas:
+                    replica.dictdb[table_name] = table_cls(table_name,
+                            replica.dictdb)
+                    replica.share_references(self.dictdb)
+                setattr(self, table_name, apitable)
+
+            for table_name in dropped:
+                self.dictdb.pop(table_name, None)
+                for replica in self.replicas:
+                    replica.dictdb.pop(table_name, None)
+                self.apitables.pop(table_name, None)
+                if hasattr(self, table_name):
+                    delattr(self, table_name)
+
+            self.checksums = checksums
+        return changed | dropped
+
+
+    def watch_schema(self, schema_conn, interval=SCHEMA_POLL_INTERVAL):
+        """
+        Refresh the tables in a separate thread every interval seconds, if the
+        schema has changed.  The tables are also refreshed as soon as a
+        notification is received on SCHEMA_CHANNEL, see SCHEMA_EVENT_TRIGGER.
+
+        schema_conn is used only by this thread, the connections of the API
+        are never ended by it.
+
+        Returns an Event, set it to stop watching.
+        """
+        stop = threading.Event()
+        schema_conn.autocommit = True
+        schema_conn.cursor().execute('LISTEN ' + SCHEMA_CHANNEL)
+
+        def watch():
+            while not stop.is_set():
+                select.select([schema_conn,], [], [], interval)
+                if stop.is_set():
+                    break
+                try:
+                    schema_conn.poll()
+                    del schema_conn.notifies[:]
+                    self.refresh_tables(schema_conn)
+                except psycopg2.Error:
+                    pass
+
+        thread = threading.Thread(target=watch, daemon=True)
+        thread.start()
+        return stop
+
+
+    def written(self, table_name):
+        """
+        Called after a write to a table has been commited.
+        """
+        self.single_flight.invalidate(table_name)
+        self.last_writes[table_name] = time.monotonic()
+        if table_name in self.apitables:
+            self.apitables[table_name].AGGREGATE.results.clear()
+
+
+    def read_replica(self, table_name):
+        """
+        Choose the replica a read of a table should be routed to.  Returns None
+        if the read should use the primary; because the table was written to
+        within max_staleness, or no replica is fresh enough.
+        """
+        last_write = self.last_writes.get(table_name)
+        if last_write and time.monotonic() - last_write < self.max_staleness:
+            # Read your writes
+            return None
+        with self.lock:
+            if self.replica_selection == 'least-busy':
+                replicas = sorted(self.replicas, key=lambda i: i.busy)
+            else:
+                start = self.next_replica % len(self.replicas)
+                self.next_replica = start + 1
+                replicas = self.replicas[start:] + self.replicas[:start]
+        for replica in replicas:
+            lag = replica.get_lag()
+            if lag is not None and lag <= self.max_staleness:
+                return replica
+
+
+    def batch(self, operations, atomic=False):
+        """
+        Perform a list of operations on the primary, returning the (code,
+        result) of each in order.  Each operation is a dict such as:
+
+            {'method':'PUT', 'table':'person', 'args':[], 'body':{'id':1}}
+
+        If atomic, the operations are performed in a single transaction which
+        is only commited if all of them succeed; no operation is performed
+        after one fails.  Other calls commit and rollback the API's
+        connection, so the transaction is kept on a new connection made by
+        batch_connect, which is closed after the batch.  Without it the first
+        operation of an atomic batch fails.
+        """
+        if atomic and not self.batch_connect:
+            return [(SERVICE_UNAVAILABLE,
+                error('Atomic batches are not enabled')),]
+        if atomic:
+            db_conn = self.batch_connect()
+        else:
+            db_conn, dictdb = self.db_conn, self.dictdb
+        results, written_tables = [], set()
+        watch = getattr(self.local, 'watch', None)
+        try:
+            if atomic:
+                dictdb = TracedDictDB(db_conn)
+                share_references(dictdb, self.dictdb)
+            self.local.dictdb = dictdb
+            self.local.conn = routing.conn = RoutedConnection(db_conn,
+                    self.statement_timeout, atomic)
+            if watch:
+                watch.db_conn = db_conn
+            for operation in operations:
+                code, result = self.operate(operation)
+                results.append((code, result))
+                if code >= BAD_REQUEST:
+                    if atomic:
+                        break
+                elif operation['method'] in ('DELETE', 'PUT'):
+                    written_tables.add(operation['table'])
+            if atomic and results and results[-1][0] < BAD_REQUEST:
+                db_conn.commit()
+                for table_name in written_tables:
+                    self.written(table_name)
+        finally:
+            self.local.dictdb = None
+            self.local.conn = routing.conn = None
+            if watch:
+                watch.db_conn = None
+            # Nothing should be left of a failed batch
+            db_conn.rollback()
+            if atomic:
+                db_conn.close()
+        return results
+
+
+    def operate(self, operation):
+        """
+        Perform a single operation of a batch.
+        """
+        try:
+            method_name, table_name = operation['method'], operation['table']
+            a = list(operation.get('args') or [])
+            kw = dict(operation.get('body') or {})
+        except (KeyError, TypeError, ValueError):
+            return (BAD_REQUEST, error('Invalid operation'))
+        # Such as the keys of a MessagePack or CBOR body, which may be bytes
+        if not isinstance(method_name, str) or \
+                not isinstance(table_name, str) or \
+                not all(isinstance(i, str) for i in kw):
+            return (BAD_REQUEST, error('Invalid operation'))
+        if method_name not in BATCH_METHODS:
+            return (BAD_REQUEST, error('Invalid method'))
+        if table_name not in self.apitables:
+            return (NOT_FOUND, error('No table named {}'.format(table_name)))
+        try:
+            return getattr(self.apitables[table_name], method_name)(*a, **kw)
+        except psycopg2.Error as e:
+            # Such as an invalid value, or a violated constraint.  The
+            # transaction of an atomic batch is rolled-back once it stops.
+            self.local.conn.rollback()
+            return (BAD_REQUEST, error(e.diag.message_primary or e))
+
+
+    @contextmanager
+    def deadline(self, seconds=None, disconnected=None):
+        """
+        Cancel the query being run by the calls made within this context, once
+        it has lasted more than seconds, or once disconnected() returns True.
+        Both are checked every DEADLINE_POLL_INTERVAL seconds.  Cancelled calls
+        respond with SERVICE_UNAVAILABLE.
+
+        Only statements executed by this thread are cancelled, see Watch.  A
+        statement that was waiting for another thread's statement on a shared
+        connection is cancelled once it starts.
+        """
+        watch = Watch()
+        start = time.monotonic()
+
+        def watcher():
+            while not watch.done.wait(DEADLINE_POLL_INTERVAL):
+                if watch.cancelled or \
+                        (seconds and time.monotonic() - start > seconds) or \
+                        (disconnected and disconnected()):
+                    watch.cancel()
+
+        self.local.watch = watch
+        thread = threading.Thread(target=watcher, daemon=True)
+        thread.start()
+        try:
+            yield watch
+        finally:
+            watch.done.set()
+            self.local.watch = None
+
+
+    @contextmanager
+    def trace(self, method, a, kw):
+        """
+        Record the statements executed by a traced method's call.  If the call
+        lasts slow_request_threshold seconds or more, it is kept in
+        slow_requests and logged to the "dictapi.slow" logger, along with the
+        statements and their durations.  See log_slow_requests.
+
+        A sample of slow requests, explain_sample_rate, have their SELECT
+        statements run again with EXPLAIN (ANALYZE, BUFFERS) by a single
+        worker thread, using explain_conn.  The request is logged once its
+        plans have been added.  Only EXPLAIN_QUEUE_SIZE requests wait to be
+        explained, any more are logged without their plans.
+        """
+        if not method.traced or self.slow_request_threshold is None or \
+                getattr(tracing, 'statements', None) is not None:
+            yield
+            return
+
+        tracing.statements = statements = []
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            tracing.statements = None
+        seconds = time.perf_counter() - start
+        if seconds < self.slow_request_threshold:
+            return
+
+        request = {
+                'time':datetime.now().strftime(DATETIME_FORMAT),
+                'table':method.table_name,
+                'method':type(method).__name__,
+                'args':list(a),
+                'kwargs':kw,
+                'seconds':seconds,
+                'statements':statements,
+                }
+        self.slow_requests.append(request)
+        if self.explain_conn and random.random() < self.explain_sample_rate:
+            with self.explain_lock:
+                if not self.explain_thread:
+                    self.explain_thread = threading.Thread(
+                            target=self.explain_worker, daemon=True)
+                    self.explain_thread.start()
+            try:
+                self.explain_queue.put_nowait(request)
+                return
+            except queue.Full:
+                pass
+        SLOW_LOG.warning(json.dumps(request, default=str))
+
+
+    def explain_worker(self):
+        while True:
+            self.explain(self.explain_queue.get())
+
+
+    def explain(self, request):
+        """
+        Add the plan of each SELECT statement of a slow request, then log it.
+        Each statement may run for explain_timeout seconds, it may have been
+        cancelled when it was slow.
+        """
+        curs = self.explain_conn.cursor()
+        try:
+            curs.execute('SET LOCAL statement_timeout = %s',
+                    [int(self.explain_timeout * 1000),])
+            for statement in request['statements']:
+                if statement['sql'].lstrip()[:6].upper() != 'SELECT':
+                    continue
+                curs.execute(EXPLAIN + statement['sql'])
+                statement['plan'] = curs.fetchone()[0]
+        except psycopg2.Error as e:
+            request['explain_error'] = str(e)
+        finally:
+            self.explain_conn.rollback()
+        SLOW_LOG.warning(json.dumps(request, default=str))
+
+
+    def log_slow_requests(self, path, max_bytes=SLOW_LOG_BYTES,
+            backup_count=SLOW_LOG_BACKUPS):
+        """
+        Log slow requests, one JSON object per line, to a file that is rotated
+        every max_bytes.
+        """
+        handler = RotatingFileHandler(path, maxBytes=max_bytes,
+                backupCount=backup_count)
+        SLOW_LOG.addHandler(handler)
+        return handler
+
+
+    def routed(self):
+        """
+        Get the DictDB the current call has been routed to, if any.
+        """
+        return getattr(self.local, 'dictdb', None)
+
+
+    @contextmanager
+    def route(self, method):
+        """
+        Route all queries of an HTTPMethod's call to a database.  Read only
+        methods are routed to a replica when possible, everything else is
+        routed to the primary.  Calls made within a routed call (such as the
+        GET of a PUT) use the same database.
+
+        The replica of the last call routed in this thread, or None, is kept
+        in local.replica.
+        """
+        if self.routed():
+            yield
+            return
+
+        replica = None
+        if method.read_only and self.replicas:
+            replica = self.read_replica(method.table_name)
+        self.local.replica = replica
+        if replica:
+            with self.lock:
+                replica.busy += 1
+        dictdb = replica.dictdb if replica else self.dictdb
+        self.local.dictdb = dictdb
+        self.local.conn = routing.conn = RoutedConnection(dictdb.conn,
+                method.get_statement_timeout())
+        watch = getattr(self.local, 'watch', None)
+        if watch:
+            watch.db_conn = dictdb.conn
+        try:
+            yield
+        finally:
+            timeout = self.local.conn.timeout_set
+            self.local.dictdb = None
+            self.local.conn = routing.conn = None
+            if watch:
+                watch.db_conn = None
+            if replica or timeout:
+                # End the transaction the statement timeout was set in
+                dictdb.conn.rollback()
+            if replica:
+                with self.lock:
+                    replica.busy -= 1
+
+
     @classmethod
     def table_factory(cls): return APITable
 
@@ -0,0 +1,96 @@
+from dictapi.cache import SharedCache, SLOT_HEADER_SIZE
+import fcntl
+import os
+import tempfile
+import unittest
+
+
+class TestSharedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'cache')
+        self.cache = SharedCache(self.path, slots=16, slot_size=128)
+
+
+    def tearDown(self):
+        self.cache.close()
+        self.dir.cleanup()
+
+
+    def test_get_put(self):
+        cache = self.cache
+        self.assertIsNone(cache.get('person', '1'))
+        generation = cache.generation('person')
+        self.assertTrue(cache.put('person', '1', b'{"id": 1}', generation))
+        self.assertEqual(cache.get('person', '1'), b'{"id": 1}')
+        self.assertIsNone(cache.get('person', '2'))
+
+        # Replace the value of a key
+        self.assertTrue(cache.put('person', '1', b'{}', generation))
+        self.assertEqual(cache.get('person', '1'), b'{}')
+
+        # Values larger than a slot are not cached
+        self.assertFalse(cache.put('person', '2',
+            b'x' * (128 - SLOT_HEADER_SIZE + 1), generation))
+        self.assertIsNone(cache.get('person', '2'))
+
+
+    def test_invalidate(self):
+        cache = self.cache
+        generation = cache.generation('person')
+        cache.put('person', '1', b'jake', generation)
+        cache.put('department', '1', b'sales', cache.generation('department'))
+
+        cache.invalidate('person')
+        self.assertIsNone(cache.get('person', '1'))
+        self.assertEqual(cache.get('department', '1'), b'sales')
+
+        # A value read before the invalidation is not stored
+        self.assertFalse(cache.put('person', '1', b'jake', generation))
+        self.assertIsNone(cache.get('person', '1'))
+
+
+    def test_shared(self):
+        """
+        Every cache that maps the same file shares its entries and
+        invalidations.
+        """
+        other = SharedCache(self.path, slots=16, slot_size=128)
+        self.cache.put('person', '1', b'jake', self.cache.generation('person'))
+        self.assertEqual(other.get('person', '1'), b'jake')
+
+        other.invalidate('person')
+        self.assertIsNone(self.cache.get('person', '1'))
+        other.close()
+
+        self.assertRaises(ValueError, SharedCache, self.path, slots=32,
+                slot_size=128)
+
+
+    def test_eviction(self):
+        cache = self.cache
+        generation = cache.generation('person')
+        for i in range(100):
+            cache.put('person', str(i), str(i).encode(), generation)
+        self.assertEqual(cache.get('person', '99'), b'99')
+        hits = [i for i in range(100) if cache.get('person', str(i))]
+        self.assertLessEqual(len(hits), 16)
+        for i in hits:
+            self.assertEqual(cache.get('person', str(i)), str(i).encode())
+
+
+    def test_fork(self):
+        """
+        A forked process can't write while its parent holds the lock.
+        """
+        with self.cache.locked():
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    fcntl.flock(self.cache.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os._exit(1)
+                except BlockingIOError:
+                    os._exit(0)
+            _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
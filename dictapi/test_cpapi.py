@@ -1,12 +1,17 @@
-from dictapi.cpapi import API
+from dictapi.cache import SharedCache
+from dictapi.cpapi import API, msgpack, cbor2, no_refs
 from dictapi.dictapi import NoRead, NoWrite, LastModified, COLLECTION_SIZE
-from dictapi.test_dictapi import BaseTest
+from dictapi.dictapi import Replica
+from dictapi.test_dictapi import BaseTest, test_db_login, test_replica_login
 from functools import partial
+from datetime import datetime
 import cherrypy
 import json
 import os
 import psycopg2
 import requests
+import tempfile
+import types
 import unittest
 
 
@@ -61,6 +66,21 @@ class BaseCherryPy(BaseTest):
 
 
 
+class TestNoRefs(unittest.TestCase):
+
+    def test_expanded(self):
+        class Entry(dict):
+            table = types.SimpleNamespace(refs={'manager':None,
+                'subordinates':None})
+
+        entry = Entry(id=1, manager=None, subordinates=[])
+        self.assertEqual(no_refs(entry), {'id':1})
+        # An expanded reference is kept, even when nothing was referenced
+        entry.expanded = frozenset(['manager'])
+        self.assertEqual(no_refs(entry), {'id':1, 'manager':None})
+
+
+
 class TestAPICherryPy(BaseCherryPy):
 
 
@@ -273,3 +293,239 @@ class TestAPICherryPy(BaseCherryPy):
         self.assertEqual(response.json(), expected_options)
 
 
+    def test_export(self):
+        self.api.export_connect = partial(psycopg2.connect, **test_db_login)
+        for name in ('Jake', 'Phil'):
+            self.put('/person', data={'name':name})
+
+        response = self.get('/person/_export')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Type'],
+                'application/x-ndjson')
+        persons = [json.loads(i) for i in response.content.splitlines()]
+        self.assertEqual(sorted(i['name'] for i in persons), ['Jake', 'Phil'])
+
+        response = self.get('/person/_export', params={'format':'csv',
+            'fields':'id,name'})
+        self.assertEqual(response.headers['Content-Type'], 'text/csv')
+        self.assertEqual(response.text.splitlines(),
+                ['id,name', '1,Jake', '2,Phil'])
+
+        error = self.get('/person/_export', params={'fields':'foo'})
+        self.assertError(400, error)
+
+
+    def test_import(self):
+        body = '{"name":"Jake"}\n{"name":"Phil"}\n'
+        response = self.put('/person/_import', data=body)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['imported'], 2)
+
+        body = 'id,name\n1,Bob\n'
+        response = self.put('/person/_import', data=body,
+                params={'format':'csv'})
+        self.assertEqual(response.json()['imported'], 1)
+        self.assertResponse(200, self.get('/person/1'), {'name':'Bob'})
+
+
+    def test_expand(self):
+        Person = self.api.person.table
+        Person['manager'] = Person['manager_id'] == Person['id']
+        self.put('/person', data={'name':'Jake'})
+        self.put('/person', data={'name':'Phil', 'manager_id':1})
+
+        phil = self.get('/person/2', params={'expand':'manager'}).json()
+        self.assertDictContains(phil['manager'], {'id':1, 'name':'Jake'})
+
+        persons = self.get('/person', params={'expand':'manager'},
+                headers={'Range':'1-'}).json()
+        self.assertEqual(persons[0]['manager'], None)
+        self.assertEqual(persons[1]['manager']['name'], 'Jake')
+
+        # References are not included unless expanded
+        phil = self.get('/person/2').json()
+        self.assertNotIn('manager', phil)
+
+
+    def test_json_body(self):
+        response = self.put('/person', data=json.dumps({'name':'Jake'}),
+                headers={'Content-Type':'application/json'})
+        self.assertResponse(201, response, {'id':1, 'name':'Jake'})
+
+        error = self.put('/person', data='[1, 2]',
+                headers={'Content-Type':'application/json'})
+        self.assertError(400, error)
+
+
+    @unittest.skipUnless(msgpack, 'msgpack is not installed')
+    def test_msgpack(self):
+        headers = {'Content-Type':'application/msgpack',
+                'Accept':'application/msgpack'}
+        response = self.put('/person', data=msgpack.packb({'name':'Jake'}),
+                headers=headers)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.headers['Content-Type'],
+                'application/msgpack')
+        jake = msgpack.unpackb(response.content, timestamp=3)
+        self.assertEqual(jake['name'], 'Jake')
+        # Timestamps are encoded natively
+        self.assertIsInstance(jake['last_modified'], datetime)
+
+        response = self.get('/person', headers={'Range':'1-',
+            'Accept':'application/msgpack'})
+        persons = msgpack.unpackb(response.content, timestamp=3)
+        self.assertEqual([i['name'] for i in persons], ['Jake'])
+
+        # A GET then PUT never shifts timestamps, whatever the TimeZone of the
+        # session is
+        self.curs.execute("SET TIME ZONE 'America/New_York'")
+        self.conn.commit()
+        before = self.get('/person/1').json()['last_modified']
+        response = self.get('/person/1', headers=headers)
+        jake = msgpack.unpackb(response.content, timestamp=3)
+        self.put('/person', data=msgpack.packb({'id':1,
+            'last_modified':jake['last_modified']}, datetime=True),
+            headers=headers)
+        self.assertEqual(self.get('/person/1').json()['last_modified'],
+                before)
+
+        # Keys must be strings
+        error = self.put('/person', data=msgpack.packb({b'name':'Phil'}),
+                headers=headers)
+        self.assertEqual(error.status_code, 400)
+
+        # JSON is the default
+        response = self.get('/person/1', headers={'Accept':'text/html'})
+        self.assertEqual(response.headers['Content-Type'], 'application/json')
+        self.assertEqual(response.json()['name'], 'Jake')
+
+
+    @unittest.skipUnless(cbor2, 'cbor2 is not installed')
+    def test_cbor(self):
+        headers = {'Content-Type':'application/cbor',
+                'Accept':'application/cbor'}
+        response = self.put('/person', data=cbor2.dumps({'name':'Jake'}),
+                headers=headers)
+        jake = cbor2.loads(response.content)
+        self.assertEqual(jake['name'], 'Jake')
+        self.assertIsInstance(jake['last_modified'], datetime)
+
+
+    def test_batch(self):
+        operations = [
+                {'method':'PUT', 'table':'person', 'body':{'name':'Jake'}},
+                {'method':'GET', 'table':'person', 'args':[1,]},
+                ]
+        response = self.post('/_batch', data=json.dumps(operations),
+                headers={'Content-Type':'application/json'})
+        self.assertEqual(response.status_code, 200)
+        (put_code, jake), (get_code, jake2) = response.json()
+        self.assertEqual([put_code, get_code], [201, 200])
+        self.assertEqual(jake, jake2)
+
+        # A failed atomic batch changes nothing
+        self.api.batch_connect = partial(psycopg2.connect, **test_db_login)
+        operations = [
+                {'method':'PUT', 'table':'person', 'body':{'name':'Phil'}},
+                {'method':'DELETE', 'table':'person', 'args':[5,]},
+                ]
+        response = self.post('/_batch', data=json.dumps(operations),
+                params={'atomic':'true'},
+                headers={'Content-Type':'application/json'})
+        self.assertEqual([i[0] for i in response.json()], [201, 404])
+        self.assertError(404, self.get('/person/2'))
+
+        error = self.post('/_batch', data='{}',
+                headers={'Content-Type':'application/json'})
+        self.assertError(400, error)
+
+
+    def test_refresh_tables(self):
+        self.curs.execute('''CREATE TABLE car (id SERIAL PRIMARY KEY,
+            name TEXT)''')
+        self.conn.commit()
+        self.assertEqual(self.api.refresh_tables(), {'car',})
+
+        response = self.put('/car', data={'name':'Herbie'})
+        self.assertResponse(201, response, {'id':1, 'name':'Herbie'})
+        self.assertResponse(200, self.get('/car/1'), {'name':'Herbie'})
+
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.api.cache = SharedCache(os.path.join(directory, 'cache'))
+            self.put('/person', data={'name':'Jake'})
+            jake = self.get('/person/1').json()
+
+            # Cached responses are served without querying the database
+            self.curs.execute('DELETE FROM person')
+            self.conn.commit()
+            self.assertEqual(self.get('/person/1').json(), jake)
+
+            # A write through the API invalidates the cached response
+            self.put('/person', data={'name':'Phil'})
+            self.assertError(404, self.get('/person/1'))
+
+            # References aren't cached, they may contain entries written
+            # elsewhere
+            person = self.api.person.table
+            person['subordinates'] = person['id'].many(person['manager_id'])
+            self.assertEqual(self.get('/person/2/subordinates').json(), [])
+            self.curs.execute('''INSERT INTO person (name, manager_id)
+                VALUES ('Bob', 2)''')
+            self.conn.commit()
+            subordinates = self.get('/person/2/subordinates').json()
+            self.assertEqual([i['name'] for i in subordinates], ['Bob'])
+
+            # Entries read from a replica aren't cached, it may not have
+            # replayed the write that invalidated the cache
+            replica_conn = psycopg2.connect(**test_replica_login)
+            self.api.replicas = [Replica(replica_conn, self.api.dictdb),]
+            self.api.last_writes.clear()
+            self.assertEqual(self.get('/person/3').json()['name'], 'Bob')
+            self.curs.execute('DELETE FROM person WHERE id = 3')
+            self.conn.commit()
+            self.assertError(404, self.get('/person/3'))
+            self.api.replicas = []
+            replica_conn.close()
+            self.api.cache.close()
+            self.api.cache = None
+
+
+    def test_aggregate(self):
+        for name in ('Jake', 'Phil', 'Bob'):
+            self.put('/person', data={'name':name})
+
+        response = self.get('/person/_aggregate',
+                params={'aggregates':'count,avg:id'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [{'count':3, 'avg_id':2},])
+
+        error = self.get('/person/_aggregate', params={'aggregates':'foo'})
+        self.assertError(400, error)
+        # A repeated parameter is invalid
+        error = self.get('/person/_aggregate',
+                params={'aggregates':['count', 'max:id']})
+        self.assertError(400, error)
+
+
+    def test_slow_requests(self):
+        self.put('/person', data={'name':'Jake'})
+        self.api.slow_request_threshold = 0
+        self.get('/person/1')
+        self.get('/department/1')
+
+        # Slow requests are only served once enabled
+        self.assertError(404, self.get('/_slow'))
+        self.api.serve_slow_requests = True
+        response = self.get('/_slow', params={'table':'person'})
+        self.assertEqual(response.status_code, 200)
+        request, = response.json()
+        self.assertEqual(request['args'], ['1',])
+        self.assertTrue(request['statements'])
+
+        self.assertEqual(self.get('/_slow', params={'min_seconds':60}).json(),
+                [])
+        self.assertError(400, self.get('/_slow', params={'min_seconds':'a'}))
+        self.assertError(400, self.get('/_slow',
+            params={'min_seconds':['1', '2']}))
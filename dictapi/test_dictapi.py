@@ -1,8 +1,17 @@
 from dictapi.dictapi import API, COLLECTION_SIZE, NoRead, NoWrite, LastModified
+from dictapi.dictapi import AGGREGATE, AGGREGATE_RESULTS_KEPT
+from dictapi.dictapi import HTTPMethod, OK, SingleFlight, Watch, execution
 from functools import partial
+import io
+import json
+import logging
 import os
 import psycopg2
 import requests
+import tempfile
+import threading
+import time
+import types
 import unittest
 
 
@@ -23,8 +32,14 @@ else:
             'port':'5432',
             }
 
+# Reads are routed to this database, this may be a second instance replicating
+# the first
+test_replica_login = test_db_login
+
 
 DB_SCHEMA = '''
+DROP MATERIALIZED VIEW IF EXISTS person_names;
+DROP TABLE IF EXISTS car CASCADE;
 DROP TABLE IF EXISTS person_department CASCADE;
 DROP TABLE IF EXISTS person CASCADE;
 DROP TABLE IF EXISTS department CASCADE;
@@ -206,7 +221,7 @@ class TestAPI(BaseTest):
             self.assertDictContains(person, {'name':name})
 
         # It is also possible to request entries less than the end
-        code, persons = self.api.person.GET_RANGE('-25')
+        code, persons = self.api.person.GET_RANGE('-24')
         self.assertEqual(code, 200, msg=persons)
         self.assertEqual(len(persons), 20)
         last_id = 0
@@ -217,6 +232,40 @@ class TestAPI(BaseTest):
         self.conn.rollback()
 
 
+    def test_collection_size(self):
+        for i in range(24):
+            self.api.dictdb['person'](name='Jake').flush()
+        self.conn.commit()
+
+        # Each table has its own collection size
+        self.api.person.collection_size = 5
+        code, persons = self.api.person.GET_RANGE(None)
+        self.assertEqual(len(persons), 5)
+        code, persons = self.api.person.GET_RANGE('21-')
+        self.assertEqual([i['id'] for i in persons], [21, 22, 23, 24])
+        # A wider range is limited to the end of the range
+        code, persons = self.api.person.GET_RANGE('10-20')
+        self.assertEqual(len(persons), 5)
+        self.assertEqual([i['id'] for i in persons], [16, 17, 18, 19, 20])
+        code, persons = self.api.person.GET_RANGE('-20')
+        self.assertEqual(len(persons), 5)
+        code, departments = self.api.department.GET_RANGE(None)
+        self.assertEqual(code, 404)
+
+        # The collection size may be limited by the estimated bytes of entries
+        self.curs.execute('ANALYZE person')
+        self.conn.commit()
+        width = self.api.person.GET_RANGE.get_entry_width()
+        self.assertGreater(width, 0)
+        self.api.person.collection_bytes = width * 3
+        code, persons = self.api.person.GET_RANGE(None)
+        self.assertEqual(len(persons), 3)
+        # But never exceeds the collection size
+        self.api.person.collection_bytes = width * 100
+        code, persons = self.api.person.GET_RANGE(None)
+        self.assertEqual(len(persons), 5)
+
+
     def test_reference(self):
         _, jake = self.api.person.PUT(name='Jake')
         _, sales = self.api.department.PUT(name='Sales')
@@ -234,6 +283,39 @@ class TestAPI(BaseTest):
         self.assertEqual(sales, sales2)
 
 
+    def test_expand(self):
+        Person = self.api.person.table
+        Person['manager'] = Person['manager_id'] == Person['id']
+        Person['subordinates'] = Person['id'].many(Person['manager_id'])
+        self.api.person.GET.modify(NoRead, 'password_hash')
+
+        _, jake = self.api.person.PUT(name='Jake', password_hash='foo')
+        _, phil = self.api.person.PUT(name='Phil', manager_id=1)
+        _, bob = self.api.person.PUT(name='Bob', manager_id=1)
+
+        code, phil = self.api.person.GET(2, expand='manager')
+        self.assertEqual(code, 200)
+        self.assertEqual(phil['manager']['name'], 'Jake')
+        # The modifiers of the referenced table's GET are applied
+        self.assertNotIn('password_hash', phil['manager'])
+
+        code, persons = self.api.person.GET_RANGE(None,
+                expand='manager,subordinates')
+        self.assertEqual(code, 200)
+        # Get the embedded values, not the references
+        persons = [dict(i) for i in persons]
+        self.assertEqual([i['manager'] and i['manager']['id'] for i in
+            persons], [None, 1, 1])
+        self.assertEqual([i['name'] for i in persons[0]['subordinates']],
+                ['Phil', 'Bob'])
+        self.assertEqual(persons[1]['subordinates'], [])
+
+        # Substratums and unknown references can't be expanded
+        self.reference_pd()
+        self.assertError(400, self.api.person.GET(1, expand='department'))
+        self.assertError(400, self.api.person.GET_RANGE(None, expand='foo'))
+
+
     def test_reference_delete(self):
         _, jake = self.api.person.PUT(name='Jake')
         _, sales = self.api.department.PUT(name='Sales')
@@ -354,4 +436,631 @@ class TestAPI(BaseTest):
         self.assertTrue(called, msg='FakeLastModified was not called')
 
 
+    def test_written(self):
+        single_flight = self.api.single_flight
+        key = single_flight.key('person', 'GET', (1,), {})
+
+        # A write to person changes the key of any following GET
+        self.api.person.PUT(name='Jake')
+        self.assertNotEqual(key, single_flight.key('person', 'GET', (1,), {}))
+
+        # Other tables are unaffected
+        key = single_flight.key('department', 'GET', (1,), {})
+        self.api.person.DELETE(1)
+        self.assertEqual(key,
+                single_flight.key('department', 'GET', (1,), {}))
+
+
+    def test_export(self):
+        self.assertError(503, self.api.person.EXPORT())
+        self.api.export_connect = partial(psycopg2.connect, **test_db_login)
+        for name in ('Jake', 'Phil', 'Bob'):
+            self.api.person.PUT(name=name)
+
+        code, chunks = self.api.person.EXPORT()
+        self.assertEqual(code, 200)
+        persons = [json.loads(i) for i in b''.join(chunks).splitlines()]
+        self.assertEqual(sorted(i['name'] for i in persons),
+                ['Bob', 'Jake', 'Phil'])
+        self.assertIn('password_hash', persons[0])
+
+        # Export only some columns of some entries
+        code, chunks = self.api.person.EXPORT(fields='id,name', name='Bob')
+        persons = [json.loads(i) for i in b''.join(chunks).splitlines()]
+        self.assertEqual(persons, [{'id':3, 'name':'Bob'}])
+
+        code, chunks = self.api.person.EXPORT(format='csv', fields='name',
+                id='1')
+        self.assertEqual(b''.join(chunks).splitlines(), [b'name', b'Jake'])
+
+        # Stopping an export early stops the COPY
+        code, chunks = self.api.person.EXPORT()
+        next(chunks)
+        chunks.close()
+
+        self.assertError(400, self.api.person.EXPORT(format='xml'))
+        self.assertError(400, self.api.person.EXPORT(id='abc'))
+        self.assertError(400, self.api.person.EXPORT(id=['1', '2']))
+        self.assertError(400, self.api.person.EXPORT(format=['csv', 'csv']))
+        self.assertError(400, self.api.person.EXPORT(fields=['id', 'name']))
+
+
+    def test_export_hidden(self):
+        self.api.export_connect = partial(psycopg2.connect, **test_db_login)
+        self.api.person.PUT(name='Jake', password_hash='foo')
+        self.api.person.GET.modify(NoRead, 'password_hash')
+
+        code, chunks = self.api.person.EXPORT()
+        persons = [json.loads(i) for i in b''.join(chunks).splitlines()]
+        self.assertEqual(list(persons[0]),
+                ['id', 'name', 'manager_id', 'last_modified'])
+
+        # A hidden column can't be exported or used to filter
+        self.assertError(400,
+                self.api.person.EXPORT(fields='id,password_hash'))
+        self.assertError(400, self.api.person.EXPORT(password_hash='foo'))
+        self.assertError(400, self.api.person.EXPORT(fields='foo'))
+        self.assertError(400, self.api.person.EXPORT(foo='bar'))
+
+
+    def test_import(self):
+        body = [
+                b'{"name":"Jake"}\n',
+                b'{"name":"Phil", "password_hash":"foo"}\n',
+                b'not json\n',
+                b'{"foo":"bar"}\n',
+                b'\n',
+                b'{"id":1, "name":"Bob"}\n',
+                ]
+        progress = []
+        code, result = self.api.person.IMPORT(body,
+                progress=lambda *a: progress.append(a))
+        self.assertEqual(code, 200)
+        self.assertEqual(result['imported'], 3)
+        self.assertEqual(result['error_count'], 2)
+        self.assertEqual([i['lines'] for i in result['errors']],
+                [[3, 3], [4, 4]])
+        self.assertEqual(progress, [(3, 2)])
+
+        # Entries with primary keys are updated
+        code, persons = self.api.person.GET_RANGE(None)
+        self.assertEqual(sorted(i['name'] for i in persons), ['Bob', 'Phil'])
+
+        # The modifiers of PUT are applied to each entry
+        self.api.person.PUT.modify(NoWrite, 'password_hash')
+        self.api.person.PUT.modify(LastModified, 'last_modified')
+        body = 'id,name,password_hash\n5,Alice,\n6,Steve,bar\n'
+        code, result = self.api.person.IMPORT(io.StringIO(body),
+                format='csv')
+        self.assertEqual(result['imported'], 1)
+        self.assertEqual(result['errors'], [{'lines':[3, 3],
+            'message':'Cannot write to password_hash'}])
+        code, alice = self.api.person.GET(5)
+        self.assertEqual(alice['name'], 'Alice')
+
+        # The batch that fails is reported
+        body = ['{"id":"foo"}']
+        code, result = self.api.person.IMPORT(body)
+        self.assertEqual(result['imported'], 0)
+        self.assertEqual(result['errors'][0]['lines'], [1, 1])
+
+        # Undecodable lines, NUL characters and CSV errors are reported
+        body = [b'{"name":"\xff"}\n', b'{"name":"a\\u0000"}\n']
+        code, result = self.api.person.IMPORT(body)
+        self.assertEqual(result['errors'], [
+            {'lines':[1, 1], 'message':'Invalid UTF-8'},
+            {'lines':[2, 2], 'message':'Invalid NUL character'},
+            ])
+        body = [b'name\n', b'"' + b'x' * 200000 + b'"\n', b'Zed\n']
+        code, result = self.api.person.IMPORT(body, format='csv')
+        self.assertEqual(result['imported'], 1)
+        self.assertEqual(result['errors'][0]['lines'], [2, 2])
+
+        self.assertError(400, self.api.person.IMPORT([], format='xml'))
+
+        # A cancelled import stops, instead of reporting each batch
+        def cancelled(batch):
+            raise psycopg2.extensions.QueryCanceledError()
+        self.api.person.IMPORT.merge = cancelled
+        self.assertError(503, self.api.person.IMPORT(['{"name":"Jake"}']))
+
+
+    def test_batch(self):
+        results = self.api.batch([
+            {'method':'PUT', 'table':'person', 'body':{'name':'Jake'}},
+            {'method':'PUT', 'table':'department', 'body':{'name':'Sales'}},
+            {'method':'GET', 'table':'person', 'args':[1,]},
+            {'method':'GET', 'table':'foo', 'args':[1,]},
+            {'method':'EXPORT', 'table':'person'},
+            'foo',
+            {'method':'GET', 'table':{}},
+            {'method':'PUT', 'table':'person', 'body':{b'name':'Phil'}},
+            {'method':'PUT', 'table':'person', 'body':{1:2}},
+            {'method':'GET_RANGE', 'table':'person', 'args':[5,]},
+            ])
+        self.assertEqual([i[0] for i in results],
+                [201, 201, 200, 404, 400, 400, 400, 400, 400, 400])
+        self.assertEqual(results[2][1]['name'], 'Jake')
+
+        # Database errors fail only their operation
+        results = self.api.batch([
+            {'method':'PUT', 'table':'person', 'body':{'manager_id':'x'}},
+            {'method':'PUT', 'table':'person', 'body':{'manager_id':50}},
+            {'method':'GET', 'table':'person', 'args':[1,]},
+            ])
+        self.assertEqual([i[0] for i in results], [400, 400, 200])
+        self.assertTrue(results[1][1]['error'])
+
+        # Atomic batches need their own connections
+        results = self.api.batch([
+            {'method':'PUT', 'table':'person', 'body':{'name':'Phil'}},
+            ], atomic=True)
+        self.assertEqual([i[0] for i in results], [503])
+        self.api.batch_connect = partial(psycopg2.connect, **test_db_login)
+
+        # An atomic batch is rolled-back when any operation fails
+        results = self.api.batch([
+            {'method':'PUT', 'table':'person', 'body':{'name':'Phil'}},
+            {'method':'PUT', 'table':'person', 'body':{'id':'foo'}},
+            {'method':'PUT', 'table':'person', 'body':{'name':'Bob'}},
+            ], atomic=True)
+        self.assertEqual([i[0] for i in results], [201, 400])
+        self.assertError(404, self.api.person.GET(name='Phil'))
+
+        results = self.api.batch([
+            {'method':'PUT', 'table':'person', 'body':{'id':3,
+                'name':'Phil'}},
+            {'method':'DELETE', 'table':'person', 'args':[1,]},
+            {'method':'GET_RANGE', 'table':'person', 'args':['1-']},
+            ], atomic=True)
+        self.assertEqual([i[0] for i in results], [201, 200, 200])
+        self.assertEqual([i['name'] for i in results[2][1]], ['Phil'])
+        self.conn.rollback()
+        code, persons = self.api.person.GET_RANGE(None)
+        self.assertEqual([i['name'] for i in persons], ['Phil'])
+
+
+    def test_statement_timeout(self):
+        self.api.person.PUT(name='Jake')
+
+        # The method's timeout overrides the table's, which overrides the API's
+        self.api.statement_timeout = 10
+        self.api.person.statement_timeout = 0.1
+        code, persons = self.api.person.GET_RANGE(None)
+        self.assertEqual(code, 200)
+        self.api.person.GET.statement_timeout = 0.1
+        self.api.person.statement_timeout = None
+        self.assertEqual(self.api.person.GET.get_statement_timeout(), 0.1)
+        self.assertEqual(self.api.person.PUT.get_statement_timeout(), 10)
+
+        code, error = self.api.person.GET(name='Jake')
+        self.assertEqual(code, 200)
+        self.api.person.table.order_by = 'pg_sleep(1)'
+        error = self.api.person.GET(name='Jake')
+        self.assertError(504, error)
+
+        # The connection is still usable
+        self.api.person.table.order_by = None
+        self.assertEqual(self.api.person.GET(name='Jake')[0], 200)
+
+
+    def test_deadline(self):
+        self.api.person.PUT(name='Jake')
+        self.api.person.table.order_by = 'pg_sleep(1)'
+        with self.api.deadline(0.2) as watch:
+            error = self.api.person.GET(name='Jake')
+            self.assertError(503, error)
+            self.assertTrue(watch.cancelled)
+            # Calls after the deadline are not made
+            self.assertError(503, self.api.department.GET(1))
+        self.api.person.table.order_by = None
+
+        with self.api.deadline(disconnected=lambda: True):
+            time.sleep(0.2)
+            self.assertError(503, self.api.person.GET(1))
+        self.assertEqual(self.api.person.GET(1)[0], 200)
+
+
+    def test_aggregate(self):
+        jake = self.api.person.PUT(name='Jake')[1]
+        for name in ('Phil', 'Bob'):
+            self.api.person.PUT(name=name, manager_id=jake['id'])
+
+        self.assertEqual(self.api.person.AGGREGATE(),
+                (200, [{'count':3},]))
+        code, result = self.api.person.AGGREGATE('count,max:name,min:id',
+                group_by='manager_id')
+        self.assertEqual(result, [
+            {'manager_id':1, 'count':2, 'max_name':'Phil', 'min_id':2},
+            {'manager_id':None, 'count':1, 'max_name':'Jake', 'min_id':1},
+            ])
+        self.assertEqual(self.api.person.AGGREGATE('sum:id', manager_id=1),
+                (200, [{'sum_id':5},]))
+
+        self.assertError(400, self.api.person.AGGREGATE('median:id'))
+        self.assertError(400, self.api.person.AGGREGATE('sum'))
+        self.assertError(400, self.api.person.AGGREGATE('sum:foo'))
+        self.assertError(400, self.api.person.AGGREGATE(group_by='foo'))
+        self.assertError(400, self.api.person.AGGREGATE('sum:name'))
+        self.assertError(400, self.api.person.AGGREGATE(id='abc'))
+        # The connection is still usable
+        self.assertEqual(self.api.person.GET(1)[0], 200)
+
+        # Columns hidden from GET can't be aggregated
+        self.api.person.GET.modify(NoRead, 'password_hash')
+        self.assertError(400, self.api.person.AGGREGATE('max:password_hash'))
+
+        # Results are reused until they expire, or the table is written to
+        self.api.person.aggregate_ttl = 60
+        self.assertEqual(self.api.person.AGGREGATE()[1], [{'count':3},])
+        self.curs.execute('DELETE FROM person WHERE id = 3')
+        self.conn.commit()
+        self.assertEqual(self.api.person.AGGREGATE()[1], [{'count':3},])
+        self.api.person.DELETE(2)
+        self.assertEqual(self.api.person.AGGREGATE()[1], [{'count':1},])
+
+
+    def test_slow_requests(self):
+        self.api.person.PUT(name='Jake')
+        self.api.slow_request_threshold = 0.1
+        self.api.person.GET(1)
+        self.assertEqual(len(self.api.slow_requests), 0)
+
+        self.api.person.table.order_by = 'pg_sleep(0.2)'
+        explain_conn = psycopg2.connect(**test_db_login)
+        self.api.explain_conn = explain_conn
+        self.api.explain_sample_rate = 1
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'slow.log')
+            handler = self.api.log_slow_requests(path)
+            try:
+                self.assertEqual(self.api.person.GET(name='Jake')[0], 200)
+                for i in range(50):
+                    if os.path.getsize(path):
+                        break
+                    time.sleep(0.1)
+            finally:
+                logging.getLogger('dictapi.slow').removeHandler(handler)
+                handler.close()
+            with open(path) as fh:
+                logged = json.loads(fh.readline())
+        self.api.person.table.order_by = None
+
+        # An explained statement may only run for explain_timeout seconds
+        self.api.explain_timeout = 0.1
+        slow = {'statements':[{'sql':'SELECT pg_sleep(1)'},]}
+        self.api.explain(slow)
+        self.assertIn('statement timeout', slow['explain_error'])
+        self.assertNotIn('plan', slow['statements'][0])
+        explain_conn.close()
+
+        request, = self.api.slow_requests
+        self.assertEqual(logged, json.loads(json.dumps(request)))
+        self.assertEqual((request['table'], request['method']),
+                ('person', 'GET'))
+        self.assertEqual(request['kwargs'], {'name':'Jake'})
+        self.assertGreaterEqual(request['seconds'], 0.2)
+        statement = request['statements'][0]
+        self.assertIn('pg_sleep', statement['sql'])
+        self.assertIn("'Jake'", statement['sql'])
+        self.assertGreaterEqual(statement['seconds'], 0.2)
+        self.assertIn('Plan', statement['plan'][0])
+
+
+    def test_refresh_tables(self):
+        self.api.person.GET.modify(NoRead, 'password_hash')
+        self.api.person.collection_size = 5
+        self.assertEqual(self.api.refresh_tables(), set())
+
+        self.curs.execute('''CREATE TABLE car (id SERIAL PRIMARY KEY,
+            name TEXT)''')
+        self.curs.execute('ALTER TABLE person ADD COLUMN email TEXT')
+        self.curs.execute('DROP TABLE person_department')
+        self.conn.commit()
+        self.assertEqual(self.api.refresh_tables(),
+                {'car', 'person', 'person_department'})
+
+        code, car = self.api.car.PUT(name='Herbie')
+        self.assertEqual((code, car), (201, {'id':1, 'name':'Herbie'}))
+        self.assertIs(self.api.apitables['car'], self.api.car)
+
+        # The new person table has the new column, and keeps its settings
+        code, jake = self.api.person.PUT(name='Jake', email='jake@example.com',
+                password_hash='foo')
+        self.assertEqual(code, 201)
+        self.assertEqual(jake['email'], 'jake@example.com')
+        self.assertNotIn('password_hash', self.api.person.GET(1)[1])
+        self.assertEqual(self.api.person.collection_size, 5)
+        self.assertIs(self.api.person.table, self.api.dictdb['person'])
+
+        self.assertFalse(hasattr(self.api, 'person_department'))
+        self.assertNotIn('person_department', self.api.dictdb)
+
+        # DictDB doesn't load materialized views
+        self.curs.execute('''CREATE MATERIALIZED VIEW person_names AS
+            SELECT name FROM person''')
+        self.conn.commit()
+        self.assertEqual(self.api.refresh_tables(), set())
+
+
+    def test_watch_schema(self):
+        schema_conn = psycopg2.connect(**test_db_login)
+        stop = self.api.watch_schema(schema_conn, interval=0.1)
+        self.curs.execute('''CREATE TABLE car (id SERIAL PRIMARY KEY,
+            name TEXT)''')
+        self.conn.commit()
+        time.sleep(0.5)
+        stop.set()
+        time.sleep(0.2)
+        schema_conn.close()
+        self.assertIn('car', self.api.apitables)
+        # Loading the new table reads from the API's connection
+        self.conn.rollback()
+
+
+
+class TestReplica(BaseTest):
+
+    def setUp(self):
+        super().setUp()
+        self.replica_conn = psycopg2.connect(**test_replica_login)
+        self.api = API(self.conn, replicas=[self.replica_conn])
+
+
+    def tearDown(self):
+        self.replica_conn.close()
+        super().tearDown()
+
+
+    def test_routing(self):
+        replica = self.api.replicas[0]
+        self.assertIs(self.api.read_replica('person'), replica)
+
+        # Reads of person immediately after a write go to the primary
+        _, jake = self.api.person.PUT(name='Jake')
+        self.assertIsNone(self.api.read_replica('person'))
+        self.assertIs(self.api.read_replica('department'), replica)
+        _, jake2 = self.api.person.GET(1)
+        self.assertEqual(jake2.table.db, self.api.dictdb)
+        self.assertEqual(jake['name'], jake2['name'])
+
+        # Once the staleness bound has passed the replica is used again
+        self.api.max_staleness = 0
+        _, jake3 = self.api.person.GET(1)
+        self.assertEqual(jake3.table.db, replica.dictdb)
+        self.assertEqual(jake['name'], jake3['name'])
+        code, _ = self.api.person.HEAD(1)
+        self.assertEqual(code, 200)
+        self.assertEqual(replica.busy, 0)
+
+
+    def test_stale(self):
+        replica = self.api.replicas[0]
+        # A replica that has caught up isn't lagging, even once the primary
+        # has been idle for longer than max_staleness
+        time.sleep(self.api.max_staleness + 0.1)
+        self.assertEqual(replica.get_lag(), 0)
+
+        # A replica lagging too far behind is not used
+        replica.lag, replica.checked = 5, time.monotonic()
+        self.assertIsNone(self.api.read_replica('person'))
+        replica.lag = 0
+        self.assertIs(self.api.read_replica('person'), replica)
+
+
+    def test_least_busy(self):
+        replica_conn2 = psycopg2.connect(**test_replica_login)
+        try:
+            self.api = API(self.conn, replicas=[self.replica_conn,
+                replica_conn2], replica_selection='least-busy')
+            replica1, replica2 = self.api.replicas
+            replica1.busy = 1
+            self.assertIs(self.api.read_replica('person'), replica2)
+        finally:
+            replica_conn2.close()
+
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_coalesce(self):
+        single_flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def call(value):
+            calls.append(value)
+            started.set()
+            release.wait()
+            return value
+
+        def get():
+            key = single_flight.key('person', 'GET', (1,), {})
+            results.append(single_flight.do(key, call, 'jake'))
+
+        leader = threading.Thread(target=get)
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=get) for i in range(5)]
+        for thread in followers:
+            thread.start()
+        release.set()
+        for thread in [leader,] + followers:
+            thread.join()
+
+        # Only the leader executed the call, all callers got its result
+        self.assertEqual(calls, ['jake'])
+        self.assertEqual(results, ['jake']*6)
+        self.assertEqual(single_flight.flights, {})
+
+
+    def test_cancelled(self):
+        local = threading.local()
+        single_flight = SingleFlight(partial(getattr, local, 'watch', None))
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], {}
+
+        def call(name):
+            if local.watch.cancelled:
+                return 'cancelled'
+            calls.append(name)
+            if name == 'leader':
+                started.set()
+                release.wait()
+                # The leader's deadline passes while its query runs
+                local.watch.cancelled = True
+                return 'cancelled'
+            return name
+
+        def get(name, cancelled=False):
+            local.watch = Watch()
+            local.watch.cancelled = cancelled
+            key = single_flight.key('person', 'GET', (1,), {})
+            results[name] = single_flight.do(key, call, name)
+
+        leader = threading.Thread(target=get, args=('leader',))
+        leader.start()
+        started.wait()
+        # A follower whose own deadline passed doesn't wait for the leader
+        get('impatient', True)
+        self.assertEqual(results, {'impatient':'cancelled'})
+
+        follower = threading.Thread(target=get, args=('follower',))
+        follower.start()
+        time.sleep(0.2)
+        release.set()
+        leader.join()
+        follower.join()
+
+        # The follower's call was made again, not given the leader's result
+        self.assertEqual(calls, ['leader', 'follower'])
+        self.assertEqual(results['follower'], 'follower')
+        self.assertEqual(single_flight.flights, {})
+
+
+    def test_unhashable(self):
+        single_flight = SingleFlight()
+        key = single_flight.key('person', 'GET', (), {'id':[1, 2]})
+        self.assertIsNone(key)
+        self.assertEqual(single_flight.do(key, lambda: 'jake'), 'jake')
+
+
+    def test_exception(self):
+        single_flight = SingleFlight()
+        key = single_flight.key('person', 'GET', (1,), {})
+
+        def call():
+            raise ValueError('foo')
+
+        self.assertRaises(ValueError, single_flight.do, key, call)
+        # Failed flights are not kept
+        self.assertEqual(single_flight.flights, {})
+
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.rollbacks = 0
+        self.cancels = 0
+
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+    def cancel(self):
+        self.cancels += 1
+
+
+
+class FakeMethod(HTTPMethod):
+
+    def call(self, *a, **kw):
+        return (OK, {'id':1, 'name':'Jake', 'password_hash':'foo'})
+
+
+
+def new_method():
+    """
+    An HTTPMethod of a person table, that needs no database.
+    """
+    conn = FakeConnection()
+    api = types.SimpleNamespace(routed=lambda: None,
+            local=types.SimpleNamespace(),
+            dictdb=types.SimpleNamespace(conn=conn))
+    apitable = types.SimpleNamespace(api=api,
+            table=types.SimpleNamespace(name='person'))
+    return FakeMethod(apitable), conn
+
+
+
+class TestModifier(unittest.TestCase):
+
+    def test_pipeline(self):
+        method, conn = new_method()
+        method.modify(NoRead, 'password_hash')
+        method.modify(NoWrite, 'password_hash')
+        method.modify(LastModified, 'last_modified')
+
+        code, jake = method.call(name='Jake')
+        self.assertEqual(code, 200)
+        self.assertNotIn('password_hash', jake)
+        # The transaction is ended once, no matter how many modifiers
+        self.assertEqual(conn.rollbacks, 1)
+
+        # Writes are inspected before the call
+        code, error = method.call(password_hash='foo')
+        self.assertEqual(code, 400)
+        self.assertEqual(conn.rollbacks, 2)
+
+
+    def test_wrapper(self):
+        method, conn = new_method()
+        calls = []
+        def wrapper(call, column_name, *a, **kw):
+            calls.append(kw)
+            return call(*a, **kw)
+        method.modify(LastModified, 'last_modified')
+        method.modify(wrapper, 'name')
+
+        # Any callable wraps the compiled modifiers
+        code, jake = method.call(name='Jake')
+        self.assertEqual(calls, [{'name':'Jake'}])
+        self.assertEqual(conn.rollbacks, 1)
+
+
+
+class TestWatch(unittest.TestCase):
+
+    def test_cancel(self):
+        conn = FakeConnection()
+        watch = Watch()
+        watch.db_conn = conn
+
+        # Another thread's statement is never cancelled
+        execution(conn).thread = threading.get_ident() + 1
+        watch.cancel()
+        self.assertTrue(watch.cancelled)
+        self.assertEqual(conn.cancels, 0)
+
+        execution(conn).thread = threading.get_ident()
+        watch.cancel()
+        self.assertEqual(conn.cancels, 1)
+
+
+
+class TestAggregateResults(unittest.TestCase):
+
+    def test_keep(self):
+        method, conn = new_method()
+        aggregate = AGGREGATE(method.apitable)
+        aggregate.keep('expired', [], -1)
+        aggregate.keep('kept', [], 60)
+        self.assertEqual(list(aggregate.results), ['kept'])
+
+        for i in range(AGGREGATE_RESULTS_KEPT + 10):
+            aggregate.keep(i, [], 60)
+        self.assertEqual(len(aggregate.results), AGGREGATE_RESULTS_KEPT)
+        self.assertNotIn('kept', aggregate.results)
 